@@ -1,11 +1,20 @@
 from __future__ import absolute_import
 
+import collections
 import logging
-import random
+import os
+import tempfile
 import time
 import threading
 
+from . import cache
+from . import codec
+from . import index
+from . import manifest
+from . import metrics
 from . import nodes
+from . import state
+from . import status
 from . import zookeeper
 from . import util
 
@@ -17,29 +26,266 @@ __author__ = 'Michael T. Conigliaro'
 __author_email__ = 'mike [at] conigliaro [dot] org'
 __url__ = 'http://github.com/mconigliaro/conveyor'
 
-SLOT_WAIT = 3
-SLOT_WAIT_SPLAY = (0, 2)
+DEPLOY_WORKERS = 4
+DEPLOY_DEBOUNCE = 1
+RECONNECT_BACKOFF = 1
+RECONNECT_BACKOFF_MAX = 60
+CONNECT_JITTER = 5
+BATCH_LINGER = 2
+
+
+class DeploymentExecutor(object):
+    """Bounded pool of worker threads used to deploy applications"""
+
+    def __init__(self, handler, workers=DEPLOY_WORKERS):
+        """Start the worker threads"""
+
+        self.handler = handler
+        self.cv = threading.Condition()
+        self.queue = collections.deque()
+        self.pending = set()
+        self.running = set()
+        self.rerun = set()
+        self.due = {}
+        self.stopped = False
+
+        self.threads = []
+        for i in range(max(1, int(workers))):
+            thread = threading.Thread(target=self.__work, name='deploy-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, path, delay=0):
+        """Queue an application path for deployment (duplicates are merged)
+
+        A delayed path is only handed to a worker once it hasn't been submitted again for delay seconds, so a burst
+        of changes is handled once, using the newest data. A path submitted without delay is handled right away, and
+        is not held back by delayed submissions that follow it (e.g. a slot handoff followed by the counter update).
+        """
+
+        now = time.time()
+
+        self.cv.acquire()
+        try:
+            if path in self.due and self.due[path] <= now:
+                pass # already due
+            elif delay:
+                self.due[path] = max(self.due.get(path, 0), now + delay)
+            else:
+                self.due[path] = now
+
+            if path in self.running:
+                self.rerun.add(path)
+            elif path not in self.pending:
+                self.pending.add(path)
+                self.queue.append(path)
+            self.cv.notify()
+        finally:
+            self.cv.release()
+
+    def __work(self):
+        """Run queued deployments until the executor is stopped"""
+
+        while True:
+            self.cv.acquire()
+            try:
+                path = self.__next()
+                if path is None:
+                    break
+                self.pending.discard(path)
+                self.running.add(path)
+            finally:
+                self.cv.release()
+
+            try:
+                self.handler(path)
+            except Exception, e:
+                logging.getLogger().exception(e)
+            finally:
+                self.cv.acquire()
+                try:
+                    self.running.discard(path)
+                    if path in self.rerun:
+                        self.rerun.discard(path)
+                        self.pending.add(path)
+                        self.queue.append(path)
+                    self.cv.notifyAll()
+                finally:
+                    self.cv.release()
+
+    def __next(self):
+        """Wait for a queued path that is due and remove it from the queue (or return None once stopped)"""
+
+        while not self.stopped:
+            now = time.time()
+            for path in self.queue:
+                if self.due.get(path, 0) <= now:
+                    self.queue.remove(path)
+                    self.due.pop(path, None)
+                    return path
+
+            if self.queue:
+                self.cv.wait(min([self.due.get(path, 0) for path in self.queue]) - now)
+            else:
+                self.cv.wait()
+
+    def depth(self):
+        """Return the number of queued and running deployments"""
+
+        self.cv.acquire()
+        try:
+            return len(self.queue), len(self.running)
+        finally:
+            self.cv.release()
+
+    def join(self, timeout=None):
+        """Wait until there are no queued or running deployments"""
+
+        deadline = timeout and time.time() + timeout
+        self.cv.acquire()
+        try:
+            while (self.queue or self.running) and not self.stopped:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cv.wait(remaining)
+                else:
+                    self.cv.wait()
+            return not (self.queue or self.running)
+        finally:
+            self.cv.release()
+
+    def stop(self):
+        """Stop the worker threads once their current deployments are done"""
+
+        self.cv.acquire()
+        try:
+            self.stopped = True
+            self.queue.clear()
+            self.pending.clear()
+            self.due.clear()
+            self.cv.notifyAll()
+        finally:
+            self.cv.release()
+
+
+class DeploymentBatcher(object):
+    """Groups deployments that share a batch deploy command
+
+    The first deployment to join a batch waits for the linger window to pass, then takes (and deploys) everything
+    that joined in the meantime. Deployments of applications that are still part of a batch are deferred until the
+    batch is done.
+    """
+
+    def __init__(self, linger=BATCH_LINGER):
+        """Create an empty batcher"""
+
+        self.linger = float(linger)
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.members = {}
+
+    def join(self, key, path, member):
+        """Add a member to the open batch of key and return the batch's members if the caller must deploy it (or None)"""
+
+        self.lock.acquire()
+        try:
+            self.members[path] = False
+            if key in self.batches:
+                self.batches[key].append(member)
+                return None
+            self.batches[key] = [member]
+        finally:
+            self.lock.release()
+
+        time.sleep(self.linger)
+
+        self.lock.acquire()
+        try:
+            return self.batches.pop(key)
+        finally:
+            self.lock.release()
+
+    def defer(self, path):
+        """Return True if an application is part of a batch (its deployment must then be tried again once it is done)"""
+
+        self.lock.acquire()
+        try:
+            if path in self.members:
+                self.members[path] = True
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def done(self, path):
+        """Remove an application from its batch and return True if its deployment was deferred in the meantime"""
+
+        self.lock.acquire()
+        try:
+            return self.members.pop(path, False)
+        finally:
+            self.lock.release()
 
 
 class Conveyor(object):
     """The main conveyor class"""
 
-    def __init__(self, servers='localhost:2181/conveyor', timeout=10, host_id=None, groups=[]):
-        """Establish ZooKeeper session"""
+    def __init__(self, servers='localhost:2181/conveyor', timeout=10, host_id=None, groups=[], deploy_workers=DEPLOY_WORKERS, state_dir=None, state_ttl=state.STATE_TTL, deploy_log_dir=None, batch_linger=BATCH_LINGER, debounce=DEPLOY_DEBOUNCE, session_file=None, group_index=False, connect_jitter=0):
+        """Establish ZooKeeper session (a daemon using the group index only watches the applications of its groups)
+
+        Unless a saved session is resumed, the session is started after a random delay of up to connect_jitter seconds,
+        so a fleet of daemons restarted at the same time doesn't connect all at once.
+        """
+
+        self.executor = None
+        self.state_store = None
+        self.deploy_log_dir = deploy_log_dir
+        self.batcher = DeploymentBatcher(linger=batch_linger)
+        self.debounce = float(debounce)
+        self.cache = cache.NodeCache()
+        self.metrics = metrics.Registry()
+        self.slot_wait_started = {}
 
         if host_id:
             self.host = nodes.Host(path=zookeeper.path_join('hosts', host_id), data={'groups':groups})
-
+            self.executor = DeploymentExecutor(handler=self.__try_deploy, workers=deploy_workers)
+            if state_dir:
+                self.state_store = state.StateStore(path=state_dir, ttl=state_ttl)
+
+        self.servers = servers
+        self.timeout = timeout
+        self.session_file = session_file
+        self.group_index = group_index
+        self.closed = False
+        self.stale_handles = set()
         self.conn_state = None
         self.handle = None
         self.app_watchers = set()
+        self.slot_watchers = set()
+        self.app_names = {}
+        self.app_names_lock = threading.Lock()
+        self.session_id = None
+        self.restored = None
+        self.seen = {}
+        self.interrupted = set()
+
+        self.__init_metrics()
+
+        clientid = self.__load_session()
+        if clientid is None and connect_jitter:
+            delay = util.backoff(1, float(connect_jitter), float(connect_jitter))
+            logging.getLogger().info('Connecting to ZooKeeper in %.1f seconds', delay)
+            time.sleep(delay)
 
         logging.getLogger().info('Connecting to ZooKeeper: %s', servers)
         try:
             self.cv = threading.Condition()
             self.cv.acquire()
             zookeeper.deterministic_conn_order(0)
-            self.handle = zookeeper.init(servers, self.__init_watcher, timeout * 1000)
+            self.handle = zookeeper.init(servers, self.__init_watcher, timeout * 1000, clientid)
             while self.conn_state != zookeeper.CONNECTED_STATE:
                 self.cv.wait(timeout)
                 if self.conn_state != zookeeper.CONNECTED_STATE:
@@ -52,9 +298,33 @@ class Conveyor(object):
             self.cv.notify()
             self.cv.release()
 
+    def __init_metrics(self):
+        """Register the daemon's metrics"""
+
+        self.deploy_seconds = self.metrics.histogram('conveyor_deploy_seconds', 'Time spent running deploy commands', labels=('application', 'result'))
+        self.version_probe_seconds = self.metrics.histogram('conveyor_version_probe_seconds', 'Time spent running get-version commands', labels=('application',))
+        self.version_probes = self.metrics.counter('conveyor_version_probes_total', 'Installed version checks', labels=('source',))
+        self.slot_wait_seconds = self.metrics.histogram('conveyor_slot_wait_seconds', 'Time spent waiting for a free deployment slot', labels=('application',))
+        self.watch_events = self.metrics.counter('conveyor_watch_events_total', 'ZooKeeper watch events received', labels=('watcher', 'type'))
+
+        self.metrics.counter('conveyor_cas_operations_total', 'Compare-and-set operations on application nodes', labels=('operation', 'path'),
+                             function=lambda: [(key, value['operations']) for key, value in nodes.cas_conflicts.snapshot().items()])
+        self.metrics.counter('conveyor_cas_conflicts_total', 'Compare-and-set retries caused by version conflicts', labels=('operation', 'path'),
+                             function=lambda: [(key, value['conflicts']) for key, value in nodes.cas_conflicts.snapshot().items()])
+        self.metrics.counter('conveyor_cache_hits_total', 'Node reads served from the cache', function=lambda: [((), self.cache.hits)])
+        self.metrics.counter('conveyor_cache_misses_total', 'Node reads sent to ZooKeeper', function=lambda: [((), self.cache.misses)])
+        self.metrics.gauge('conveyor_deployments_queued', 'Applications waiting for a deployment worker', function=lambda: [((), self.executor and self.executor.depth()[0] or 0)])
+        self.metrics.gauge('conveyor_deployments_running', 'Applications being deployed', function=lambda: [((), self.executor and self.executor.depth()[1] or 0)])
+        self.metrics.gauge('conveyor_zookeeper_connected', 'Whether the ZooKeeper session is connected', function=lambda: [((), int(self.conn_state == zookeeper.CONNECTED_STATE))])
+        self.metrics.gauge('conveyor_zookeeper_state', 'ZooKeeper connection state', function=lambda: [((), self.conn_state or 0)])
+
     def __init_watcher(self, handle, type, state, path):
         """Handle connection state changes"""
 
+        if handle in self.stale_handles:
+            return
+
+        self.watch_events.inc(('session', type))
         logging.getLogger().debug('ZooKeeper connection state changed: %s => %s', self.conn_state, state)
         self.conn_state = state
 
@@ -62,11 +332,39 @@ class Conveyor(object):
             self.cv.acquire()
 
             if state == zookeeper.CONNECTED_STATE:
-                logging.getLogger().info('Connected to ZooKeeper with session ID: %x', zookeeper.client_id(handle)[0])
+                self.handle = handle
+                session_id = zookeeper.client_id(handle)[0]
+                resumed, self.session_id = session_id == self.session_id, session_id
+
+                if resumed:
+                    # the session (with its ephemeral nodes and watches) survived, so only retry what was interrupted
+                    logging.getLogger().info('Reconnected to ZooKeeper with session ID: %x', session_id)
+                    if hasattr(self, 'host'):
+                        interrupted, self.interrupted = self.interrupted, set()
+                        for path in sorted(interrupted):
+                            if path in self.__app_roots():
+                                self.__call_app_root_handler(roots=[path])
+                            else:
+                                self.executor.submit(path)
 
-                if hasattr(self, 'host'):
-                    self.host.write(handle=self.handle)
-                    self.__call_app_root_handler()
+                else:
+                    # a session saved by a previous run still holds the Host node, but not the watches of that run
+                    restored, self.restored = self.restored, None
+                    logging.getLogger().info('Connected to ZooKeeper with session ID: %x', session_id)
+                    self.__save_session()
+
+                    if hasattr(self, 'host'):
+                        self.cache.clear()
+                        if restored != (session_id, sorted(self.host.data['groups'])):
+                            self.host.write(handle=self.handle)
+                        self.__call_app_root_handler(rescan=True)
+
+            elif state == zookeeper.EXPIRED_SESSION_STATE:
+                logging.getLogger().warn('ZooKeeper session expired (starting a new one)')
+                self.stale_handles.add(handle)
+                thread = threading.Thread(target=self.__reconnect, args=(handle,), name='zookeeper-reconnect')
+                thread.setDaemon(True)
+                thread.start()
 
             else:
                 logging.getLogger().warn('Disconnected from ZooKeeper')
@@ -78,92 +376,419 @@ class Conveyor(object):
             self.cv.notify()
             self.cv.release()
 
-    def __call_app_root_handler(self):
-        """Call __try_deploy on all application nodes"""
+    def __reconnect(self, handle):
+        """Replace an expired session with a new one
 
-        path = zookeeper.path_join('applications')
+        Every attempt is preceded by a randomized, exponentially growing delay, so a fleet of daemons that lost their
+        sessions at the same time doesn't reconnect all at once.
+        """
+
+        try:
+            zookeeper.close(handle)
+        except zookeeper.ZooKeeperException, e:
+            logging.getLogger().debug('Unable to close expired session: %s', e)
+
+        # the watches went away with the session
+        self.app_watchers.clear()
+        self.slot_watchers.clear()
+
+        attempt = 0
+        while not self.closed:
+            attempt += 1
+            delay = util.backoff(attempt, RECONNECT_BACKOFF, RECONNECT_BACKOFF_MAX)
+            logging.getLogger().info('Reconnecting to ZooKeeper in %.1f seconds', delay)
+            time.sleep(delay)
 
-        while True:
             try:
-                for name in nodes.list_children(handle=self.handle, path=path, watcher=self.__app_root_watcher):
-                    self.__try_deploy(path=zookeeper.path_join('applications', name))
+                zookeeper.init(self.servers, self.__init_watcher, self.timeout * 1000)
                 break
-            except zookeeper.NoNodeException:
+            except zookeeper.ZooKeeperException, e:
+                logging.getLogger().error('Unable to reconnect to ZooKeeper: %s', e)
+
+    def __load_session(self):
+        """Return the (session id, password) tuple saved by a previous run (or None)
+
+        The groups of the host and the applications handled by that run are restored along with it, so resuming the
+        session doesn't rewrite the Host node or read back the applications that didn't change in the meantime.
+        """
+
+        if not self.session_file:
+            return None
+
+        try:
+            f = open(self.session_file)
+            try:
+                lines = f.read().splitlines()
+            finally:
+                f.close()
+            fields = lines[0].split()
+            clientid = (int(fields[0], 16), fields[1].decode('hex'))
+            groups = len(fields) > 2 and fields[2].split(',') or []
+            seen = {}
+            for line in lines[1:]:
+                mzxid, path = line.split(' ', 1)
+                seen[path] = int(mzxid, 16)
+        except (IOError, IndexError, ValueError, TypeError), e:
+            logging.getLogger().debug('No session to resume from %s: %s', self.session_file, e)
+            return None
+
+        logging.getLogger().info('Resuming ZooKeeper session ID: %x', clientid[0])
+        self.restored = (clientid[0], groups)
+        self.seen.update(seen)
+        return clientid
+
+    def __save_session(self):
+        """Save the session id and password (with the host's groups and the applications handled so far) so the next run can resume the session"""
+
+        if not self.session_file:
+            return
+
+        session_id, passwd = zookeeper.client_id(self.handle)
+        fields = ['%x' % session_id, passwd.encode('hex')]
+        if hasattr(self, 'host') and self.host.data['groups']:
+            fields.append(','.join(sorted(self.host.data['groups'])))
+        try:
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.session_file)))
+            try:
+                os.write(fd, ' '.join(fields) + '\n')
+                for app_path, mzxid in sorted(self.seen.items()):
+                    os.write(fd, '%x %s\n' % (mzxid, app_path))
+            finally:
+                os.close(fd)
+            os.rename(path, self.session_file)
+        except (IOError, OSError), e:
+            logging.getLogger().error('Unable to save session to %s: %s', self.session_file, e)
+
+    def __app_roots(self):
+        """Return the paths listing the applications this daemon watches (the index of each of its groups, or all of them)"""
+
+        if self.group_index:
+            return [index.path_for(group) for group in sorted(self.host.data['groups'])]
+        return [zookeeper.path_join('applications')]
+
+    def __call_app_root_handler(self, rescan=False, roots=None):
+        """Queue added application nodes for deployment (or all of them if rescan is True)
+
+        Only the specified application roots are listed again (all of them by default). On a rescan, applications
+        that were handled before are only queued if their node changed since.
+        """
+
+        listed = {}
+        for path in roots or self.__app_roots():
+            while True:
                 try:
-                    nodes.PersistentNode(path=path).write(handle=self.handle)
-                except zookeeper.NodeExistsException: # another host must have created this node already
-                    pass
-            except zookeeper.ConnectionLossException:
-                break
+                    listed[path] = set(nodes.list_children(handle=self.handle, path=path, watcher=self.__app_root_watcher))
+                    break
+                except zookeeper.NoNodeException:
+                    try:
+                        zookeeper.create_r(self.handle, path)
+                    except zookeeper.NodeExistsException: # another host must have created this node already
+                        pass
+                except zookeeper.ConnectionLossException:
+                    self.interrupted.add(path)
+                    break
+
+        self.app_names_lock.acquire()
+        try:
+            before = set().union(*self.app_names.values())
+            self.app_names.update(listed)
+            names = set().union(*self.app_names.values())
+            if rescan:
+                added, removed = names, set()
+            else:
+                added, removed = names - before, before - names
+        finally:
+            self.app_names_lock.release()
+
+        logging.getLogger().debug('Application children of %s: %d added, %d removed', ', '.join(sorted(listed)), len(added), len(removed))
+
+        for name in removed:
+            app_path = zookeeper.path_join('applications', name)
+            self.app_watchers.discard(app_path)
+            self.slot_watchers.discard(app_path)
+            self.seen.pop(app_path, None)
+
+        for name in sorted(added):
+            app_path = zookeeper.path_join('applications', name)
+            if rescan and app_path in self.seen and app_path not in self.slot_wait_started:
+                self.__reconcile(app_path)
+            else:
+                self.executor.submit(app_path)
+
+    def __reconcile(self, path):
+        """Watch an application handled in a previous session again, and queue it if it changed in the meantime"""
+
+        self.app_watchers.add(path)
+        try:
+            stat = zookeeper.exists(self.handle, path, self.__app_watcher)
+        except zookeeper.ConnectionLossException:
+            self.interrupted.add(path)
+            return
+
+        if not stat or stat['mzxid'] != self.seen.get(path):
+            self.executor.submit(path)
+        else:
+            logging.getLogger().debug('Application %s is unchanged', path)
 
     def __app_root_watcher(self, handle, type, state, path):
         """Handle application node additions/deletions"""
 
+        if type == zookeeper.SESSION_EVENT:
+            return
+
+        self.watch_events.inc(('application_root', type))
         logging.getLogger().debug('Application change detected: type=%s, state=%s, path=%s', type, state, path)
-        self.__call_app_root_handler()
+        self.__call_app_root_handler(roots=[path])
 
     def __try_deploy(self, path):
-        """Deploy applications as necessary"""
+        """Deploy applications as necessary (to be retried on reconnect if the connection is lost)"""
 
-        while True:
-            try:
-                application = nodes.Application.read(handle=self.handle, path=path)
-            except zookeeper.NoNodeException: # another host must have deleted this node already
-                application = nodes.Application(path=path)
+        try:
+            self.__try_deploy_once(path)
+        except zookeeper.ConnectionLossException:
+            logging.getLogger().warn('Connection lost while handling %s (will retry on reconnect)', path)
+            self.interrupted.add(path)
 
-            if not application.in_groups(self.host.data['groups']) or application.deployed(self.host.id):
-                break
+    def __try_deploy_once(self, path):
+        """Deploy an application if necessary, and watch it for changes"""
 
-            slot_path = zookeeper.path_join('applications', application.id, self.host.id)
+        try:
+            application = nodes.Application.read(handle=self.handle, path=path, cache=self.cache)
+        except zookeeper.NoNodeException: # another host must have deleted this node already
+            self.app_watchers.discard(path)
+            self.seen.pop(path, None)
+            self.__stop_waiting(path)
+            return
+
+        version = application.version
+        if not application.in_groups(self.host.data['groups']):
+            self.__stop_waiting(path)
+        elif not application.deployed(handle=self.handle, host_id=self.host.id):
+            version = self.__deploy(application) or version
 
-            try:
-                lversion = application.run_command(application.data['get_version_cmd'])
-            except application.CommandError:
-                lversion = '0'
+        if path not in self.app_watchers:
+            self.app_watchers.add(path)
+            stat = zookeeper.exists(self.handle, application.path, self.__app_watcher)
+
+            # the application may have been changed by someone else between reading it and setting the watch
+            if not stat or stat['version'] != version:
+                self.executor.submit(path)
+            else:
+                self.seen[path] = stat['mzxid']
+
+    def __deploy(self, application):
+        """Occupy a deployment slot and deploy an application (returns the application's version after freeing the slot)"""
+
+        if self.batcher.defer(application.path):
+            logging.getLogger().debug('Deployment of %s deferred until its batch is done', application.id)
+            return
+
+        slot_path = zookeeper.path_join('applications', application.id, self.host.id)
+
+        lversion = self.__installed_version(application)
+
+        slot = nodes.DeploymentSlot(path=slot_path)
+        try:
+            slot.occupy(handle=self.handle, cache=self.cache, watcher=self.__queue_watcher)
+
+        except nodes.Application.DeploymentSlotOverflow:
+            logging.getLogger().info('No slots available for %s %s (waiting for a slot to be freed)', application.id, application.data['version'])
+            self.slot_wait_started.setdefault(application.path, time.time())
+            if application.data['slot_mode'] != 'queue':
+                self.__wait_for_slot(application)
+            return
+
+        if application.path in self.slot_wait_started:
+            self.slot_wait_seconds.observe(time.time() - self.slot_wait_started.pop(application.path), (application.id,))
+
+        result = None
+
+        if lversion == application.data['version']:
+            logging.getLogger().info('Will NOT deploy %s %s (already installed)', application.id, application.data['version'])
+            result = True
+
+        elif application.too_many_deployment_failures():
+            logging.getLogger().info('Application %s %s has exceeded the maximum number of deployment failures (will NOT deploy)', application.id, application.data['version'])
+
+        elif application.data['batch_deploy_cmd']:
+            self.__deploy_batched(application, slot)
+            return
+
+        else:
+            result = self.__run_deploy(application)
 
+        return nodes.DeploymentSlot.free(handle=self.handle, path=slot_path, deploy_result=result, version=application.data['version'], cache=self.cache, queue_node=slot.queue_node, publish_id=application.data['publish_id'])
+
+    def __run_deploy(self, application):
+        """Run the deploy command of an application and return True if it succeeded"""
+
+        logging.getLogger().info('Deploying %s %s', application.id, application.data['version'])
+        start = time.time()
+        output = self.__open_deploy_log(application)
+        try:
+            application.run_command(application.deploy_command(), output=output, timeout=application.data['deploy_timeout'])
+        except application.CommandError:
+            result = False
+        else:
+            result = True
+        finally:
+            if output:
+                output.close()
+        self.deploy_seconds.observe(time.time() - start, (application.id, result and 'successful' or 'failed'))
+
+        if self.state_store:
+            self.state_store.invalidate(application.id)
+
+        return result
+
+    def __deploy_batched(self, application, slot):
+        """Deploy an application together with the others that share its batch deploy command
+
+        Only the worker that opened the batch deploys it (and frees every slot). If the batch command fails, the
+        applications are deployed one by one with their own deploy commands instead.
+        """
+
+        members = self.batcher.join(application.data['batch_deploy_cmd'], application.path, (application, slot))
+        if members is None:
+            logging.getLogger().debug('Added %s %s to an open deployment batch', application.id, application.data['version'])
+            return
+
+        applications = [app for app, slot in members]
+        timeouts = [app.data['deploy_timeout'] is not None and float(app.data['deploy_timeout']) or None for app in applications]
+        logging.getLogger().info('Deploying %s in one batch', ', '.join(['%s %s' % (app.id, app.data['version']) for app in applications]))
+
+        results = [False] * len(applications)
+        start = time.time()
+        try:
             try:
-                nodes.DeploymentSlot(path=slot_path).occupy(handle=self.handle)
+                nodes.Application.run_batch_command(applications, timeout=None not in timeouts and max(timeouts) or None)
+            except nodes.Application.CommandError:
+                logging.getLogger().warn('Batch deployment of %s failed (deploying one by one)', ', '.join([app.id for app in applications]))
+                results = [app.deploy_command() and self.__run_deploy(app) or False for app in applications]
+            else:
+                results = [True] * len(applications)
+                for app in applications:
+                    self.deploy_seconds.observe(time.time() - start, (app.id, 'successful'))
+                    if self.state_store:
+                        self.state_store.invalidate(app.id)
 
-                result = None
+        finally:
+            for (app, slot), result in zip(members, results):
+                try:
+                    nodes.DeploymentSlot.free(handle=self.handle, path=slot.path, deploy_result=result, version=app.data['version'], cache=self.cache, queue_node=slot.queue_node, publish_id=app.data['publish_id'])
+                except Exception, e:
+                    logging.getLogger().exception(e)
+                if self.batcher.done(app.path):
+                    self.executor.submit(app.path)
 
-                if lversion == application.data['version']:
-                    logging.getLogger().info('Will NOT deploy %s %s (already installed)', application.id, application.data['version'])
-                    result = True
+    def __open_deploy_log(self, application):
+        """Return a log file for the output of a deployment (or None)"""
 
-                elif application.too_many_deployment_failures():
-                    logging.getLogger().info('Application %s %s has exceeded the maximum number of deployment failures (will NOT deploy)', application.id, application.data['version'])
+        if not self.deploy_log_dir:
+            return None
 
-                else:
-                    logging.getLogger().info('Deploying %s %s', application.id, application.data['version'])
-                    try:
-                        application.run_command(application.data['deploy_cmd'])
-                    except application.CommandError:
-                        result = False
-                    else:
-                        result = True
+        path = os.path.join(self.deploy_log_dir, '%s-%s.log' % (application.id, nodes.DeploymentResult.quote(application.data['version'])))
+        try:
+            return open(path, 'a')
+        except IOError, e:
+            logging.getLogger().error('Unable to open deployment log %s: %s', path, e)
+            return None
+
+    def __installed_version(self, application):
+        """Return the installed version of an application (from the state store if possible)"""
+
+        if self.state_store:
+            fingerprint = state.fingerprint(application)
+            lversion = self.state_store.lookup(application.id, fingerprint)
+            if lversion is not None:
+                logging.getLogger().debug('Installed version of %s is %s (from state store)', application.id, lversion)
+                self.version_probes.inc(('state',))
+                return lversion
+
+        self.version_probes.inc(('command',))
+        start = time.time()
+        try:
+            lversion = application.run_command(application.get_version_command(), timeout=application.data['version_timeout'])
+        except application.CommandError:
+            lversion = '0'
+        else:
+            if self.state_store:
+                self.state_store.record(application.id, lversion, fingerprint)
+        self.version_probe_seconds.observe(time.time() - start, (application.id,))
 
-                nodes.DeploymentSlot.free(handle=self.handle, path=slot_path, deploy_result=result)
-                break
+        return lversion
 
-            except nodes.Application.DeploymentSlotOverflow:
-                sleep = SLOT_WAIT + random.uniform(*SLOT_WAIT_SPLAY)
-                logging.getLogger().info('No slots available for %s %s (retrying in %s seconds)', application.id, application.data['version'], sleep)
-                time.sleep(sleep)
+    def __stop_waiting(self, path):
+        """Give up waiting for a slot of an application this host no longer deploys (leaving its queue)"""
 
-        if path not in self.app_watchers:
-            self.app_watchers.add(path)
-            zookeeper.exists(self.handle, application.path, self.__app_watcher)
+        if self.slot_wait_started.pop(path, None) is not None:
+            nodes.DeploymentSlot.leave_queue(handle=self.handle, app_id=zookeeper.path_split(path)[-1], host_id=self.host.id)
+
+    def __wait_for_slot(self, application):
+        """Watch an application for freed deployment slots instead of polling it"""
+
+        if application.path not in self.slot_watchers:
+            self.slot_watchers.add(application.path)
+            zookeeper.get_children(self.handle, application.path, self.__slot_watcher)
+
+        if application.path not in self.app_watchers:
+            self.app_watchers.add(application.path)
+            stat = zookeeper.exists(self.handle, application.path, self.__app_watcher)
+        else:
+            stat = zookeeper.exists(self.handle, application.path)
+
+        # a slot may have been freed between reading the application and setting the watches
+        if not stat or stat['version'] != application.version:
+            self.executor.submit(application.path)
+
+    def __slot_watcher(self, handle, type, state, path):
+        """Handle deployment slot changes"""
+
+        if type == zookeeper.SESSION_EVENT:
+            return
+
+        self.slot_watchers.discard(path)
+        self.watch_events.inc(('slot', type))
+        logging.getLogger().debug('Deployment slot change detected: type=%s, state=%s, path=%s', type, state, path)
+        self.executor.submit(path)
+
+    def __queue_watcher(self, handle, type, state, path):
+        """Handle changes of the deployment queue (or of the host ahead of us in it)"""
+
+        if type == zookeeper.SESSION_EVENT:
+            return
+
+        self.watch_events.inc(('queue', type))
+        logging.getLogger().debug('Deployment queue change detected: type=%s, state=%s, path=%s', type, state, path)
+        self.executor.submit(zookeeper.path_join('applications', zookeeper.path_split(path)[1]))
 
     def __app_watcher(self, handle, type, state, path):
         """Handle application node changes"""
 
+        if type == zookeeper.SESSION_EVENT:
+            return
+
         self.app_watchers.discard(path)
-        if zookeeper.exists(self.handle, path):
-            logging.getLogger().debug('Application change detected: type=%s, state=%s, path=%s', type, state, path)
-            self.__try_deploy(path=path)
+        self.watch_events.inc(('application', type))
+        logging.getLogger().debug('Application change detected: type=%s, state=%s, path=%s', type, state, path)
+        self.executor.submit(path, delay=self.debounce)
+
+    def close(self, keep_session=False):
+        """Terminate ZooKeeper session (or leave it open for the next run to resume if keep_session is True)"""
+
+        self.closed = True
+
+        if self.executor:
+            self.executor.stop()
+
+        if self.state_store:
+            self.state_store.close()
 
-    def close(self):
-        """Terminate ZooKeeper session"""
+        if keep_session:
+            logging.getLogger().info('Leaving session open for the next run')
+            self.__save_session()
+            self.stale_handles.add(self.handle)
+            return
 
         logging.getLogger().info('Closing connection')
         zookeeper.close(self.handle)
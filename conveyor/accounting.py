@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+from . import zookeeper
+from .backends import Backend
+
+
+READS = ('get', 'get_children', 'exists')
+WRITES = ('create', 'set', 'delete', 'multi')
+
+
+class Operation(object):
+    """A single recorded backend call"""
+
+    __slots__ = ('handle', 'name', 'path', 'prefix', 'bytes_read', 'bytes_written', 'latency', 'error')
+
+    def __init__(self, handle, name, path, prefix, bytes_read, bytes_written, latency, error):
+        self.handle = handle
+        self.name = name
+        self.path = path
+        self.prefix = prefix
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        return '<Operation %s %s (%d bytes read, %d bytes written, %.6fs)>' % (self.name, self.path, self.bytes_read, self.bytes_written, self.latency)
+
+
+class AccountingBackend(Backend):
+    """Backend wrapper that records the type, path prefix, size and latency of every call"""
+
+    def __init__(self, backend, prefix_depth=1):
+        """Wrap a backend (path prefixes are made of the first prefix_depth path components)"""
+
+        self.backend = backend
+        self.prefix_depth = prefix_depth
+        self.lock = threading.Lock()
+        self.operations = []
+
+    def reset(self):
+        """Forget all recorded operations"""
+
+        self.lock.acquire()
+        try:
+            self.operations = []
+        finally:
+            self.lock.release()
+
+    def select(self, names=None, handle=None, prefix=None):
+        """Return recorded operations, optionally filtered by name(s), handle and path prefix"""
+
+        if isinstance(names, basestring):
+            names = (names,)
+
+        self.lock.acquire()
+        try:
+            operations = list(self.operations)
+        finally:
+            self.lock.release()
+
+        return [o for o in operations if (names is None or o.name in names) and (handle is None or o.handle == handle) and (prefix is None or o.prefix == prefix)]
+
+    def reads(self, handle=None, prefix=None):
+        """Return the number of read operations"""
+
+        return len(self.select(READS, handle=handle, prefix=prefix))
+
+    def writes(self, handle=None, prefix=None):
+        """Return the number of write operations"""
+
+        return len(self.select(WRITES, handle=handle, prefix=prefix))
+
+    def summary(self, handle=None):
+        """Return {(name, prefix): {'count', 'bytes_read', 'bytes_written', 'latency'}} totals"""
+
+        result = {}
+        for o in self.select(handle=handle):
+            totals = result.setdefault((o.name, o.prefix), {'count': 0, 'bytes_read': 0, 'bytes_written': 0, 'latency': 0.0})
+            totals['count'] += 1
+            totals['bytes_read'] += o.bytes_read
+            totals['bytes_written'] += o.bytes_written
+            totals['latency'] += o.latency
+        return result
+
+    def init(self, servers, watcher=None, timeout=10000, clientid=None):
+        return self.backend.init(servers, watcher, timeout, clientid)
+
+    def close(self, handle):
+        return self.backend.close(handle)
+
+    def client_id(self, handle):
+        return self.backend.client_id(handle)
+
+    def state(self, handle):
+        return self.backend.state(handle)
+
+    def deterministic_conn_order(self, value):
+        return self.backend.deterministic_conn_order(value)
+
+    def create(self, handle, path, data, acl, flags):
+        return self.__call('create', handle, path, len(data or ''), lambda: self.backend.create(handle, path, data, acl, flags), lambda r: 0)
+
+    def get(self, handle, path, watcher=None):
+        return self.__call('get', handle, path, 0, lambda: self.backend.get(handle, path, watcher), lambda r: len(r[0] or ''))
+
+    def set(self, handle, path, data, version=-1):
+        return self.__call('set', handle, path, len(data or ''), lambda: self.backend.set(handle, path, data, version), lambda r: 0)
+
+    def get_children(self, handle, path, watcher=None):
+        return self.__call('get_children', handle, path, 0, lambda: self.backend.get_children(handle, path, watcher), lambda r: sum(map(len, r)))
+
+    def exists(self, handle, path, watcher=None):
+        return self.__call('exists', handle, path, 0, lambda: self.backend.exists(handle, path, watcher), lambda r: 0)
+
+    def delete(self, handle, path, version=-1):
+        return self.__call('delete', handle, path, 0, lambda: self.backend.delete(handle, path, version), lambda r: 0)
+
+    def aget(self, handle, path, completion, watcher=None):
+        return self.__acall('get', handle, path, lambda c: self.backend.aget(handle, path, c, watcher), completion, lambda r: len(r[0] or ''))
+
+    def aget_children(self, handle, path, completion, watcher=None):
+        return self.__acall('get_children', handle, path, lambda c: self.backend.aget_children(handle, path, c, watcher), completion, lambda r: sum(map(len, r)))
+
+    def aexists(self, handle, path, completion, watcher=None):
+        return self.__acall('exists', handle, path, lambda c: self.backend.aexists(handle, path, c, watcher), completion, lambda r: 0)
+
+    @property
+    def supports_multi(self):
+        return self.backend.supports_multi
+
+    def multi(self, handle, ops):
+        return self.__call('multi', handle, ops and ops[0][1] or '/', sum([len(op[2] or '') for op in ops if op[0] in ('create', 'set')]), lambda: self.backend.multi(handle, ops), lambda r: 0)
+
+    def __getattr__(self, name):
+        """Pass backend-specific helpers (e.g. MemoryBackend.expire) through unrecorded"""
+
+        return getattr(self.backend, name)
+
+    def __call(self, name, handle, path, bytes_written, function, bytes_read):
+        """Call the wrapped backend and record the call"""
+
+        result = None
+        error = None
+        start = time.time()
+        try:
+            result = function()
+            return result
+        except zookeeper.ZooKeeperException, e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            self.__record(handle, name, path, error is None and bytes_read(result) or 0, bytes_written, time.time() - start, error)
+
+    def __acall(self, name, handle, path, function, completion, bytes_read):
+        """Start an asynchronous call on the wrapped backend and record it when it completes"""
+
+        start = time.time()
+
+        def complete(h, error, result):
+            self.__record(handle, name, path, error is None and bytes_read(result) or 0, 0, time.time() - start, error and error.__class__.__name__ or None)
+            completion(h, error, result)
+
+        return function(complete)
+
+    def __record(self, handle, name, path, bytes_read, bytes_written, latency, error):
+        """Record a call"""
+
+        prefix = zookeeper.path_join(*zookeeper.path_split(path)[:self.prefix_depth])
+        operation = Operation(handle, name, path, prefix, bytes_read, bytes_written, latency, error)
+        self.lock.acquire()
+        try:
+            self.operations.append(operation)
+        finally:
+            self.lock.release()
+
+
+def install(prefix_depth=1):
+    """Wrap the current backend in an AccountingBackend and return it"""
+
+    return zookeeper.set_backend(AccountingBackend(zookeeper.get_backend(), prefix_depth=prefix_depth))
+
+
+def uninstall():
+    """Remove the AccountingBackend installed by install()"""
+
+    backend = zookeeper.get_backend()
+    if isinstance(backend, AccountingBackend):
+        zookeeper.set_backend(backend.backend)
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+
+from .. import zookeeper
+
+
+class Backend(object):
+    """Interface implemented by coordination backends
+
+    Backends mirror the ZooKeeper C binding: sessions are identified by integer handles, paths are absolute, errors are
+    raised as conveyor.zookeeper exceptions and watchers are called once with (handle, type, state, path).
+    """
+
+    def init(self, servers, watcher=None, timeout=10000, clientid=None):
+        """Open a session and return its handle"""
+
+        raise NotImplementedError
+
+    def close(self, handle):
+        """Close a session (deleting its ephemeral nodes)"""
+
+        raise NotImplementedError
+
+    def client_id(self, handle):
+        """Return the (session id, password) tuple of a session"""
+
+        raise NotImplementedError
+
+    def state(self, handle):
+        """Return the connection state of a session"""
+
+        raise NotImplementedError
+
+    def create(self, handle, path, data, acl, flags):
+        """Create a node and return its path"""
+
+        raise NotImplementedError
+
+    def get(self, handle, path, watcher=None):
+        """Return the (data, stat) tuple of a node"""
+
+        raise NotImplementedError
+
+    def set(self, handle, path, data, version=-1):
+        """Update the data of a node"""
+
+        raise NotImplementedError
+
+    def get_children(self, handle, path, watcher=None):
+        """Return the names of the children of a node"""
+
+        raise NotImplementedError
+
+    def exists(self, handle, path, watcher=None):
+        """Return the stat of a node (or None)"""
+
+        raise NotImplementedError
+
+    def delete(self, handle, path, version=-1):
+        """Delete a node"""
+
+        raise NotImplementedError
+
+    def aget(self, handle, path, completion, watcher=None):
+        """Read a node asynchronously
+
+        completion is called with (handle, error, (data, stat)), error being a conveyor.zookeeper exception (or None).
+        The asynchronous calls of this class run the synchronous ones and call completion before returning.
+        """
+
+        self.__complete(handle, completion, self.get, handle, path, watcher)
+
+    def aget_children(self, handle, path, completion, watcher=None):
+        """List the children of a node asynchronously (completion is called with (handle, error, children))"""
+
+        self.__complete(handle, completion, self.get_children, handle, path, watcher)
+
+    def aexists(self, handle, path, completion, watcher=None):
+        """Stat a node asynchronously (completion is called with (handle, error, stat or None))"""
+
+        self.__complete(handle, completion, self.exists, handle, path, watcher)
+
+    supports_multi = False
+
+    def multi(self, handle, ops):
+        """Run a list of operations (see conveyor.zookeeper.create_op etc.) atomically and return their results"""
+
+        raise zookeeper.UnimplementedException('multi is not supported by %s' % self.__class__.__name__)
+
+    def deterministic_conn_order(self, value):
+        """Connect to servers in the order they are listed"""
+
+        pass
+
+    def __complete(self, handle, completion, function, *args):
+        """Call a synchronous function and pass its result (or error) to a completion"""
+
+        try:
+            result = function(*args)
+        except zookeeper.ZooKeeperException, e:
+            completion(handle, e, None)
+        else:
+            completion(handle, None, result)
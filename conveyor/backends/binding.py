@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+
+import sys
+
+import zookeeper as binding
+
+from . import Backend
+from .. import zookeeper
+
+
+ERROR_CODES = {
+    'SYSTEMERROR': 'SystemErrorException',
+    'RUNTIMEINCONSISTENCY': 'RuntimeInconsistencyException',
+    'DATAINCONSISTENCY': 'DataInconsistencyException',
+    'CONNECTIONLOSS': 'ConnectionLossException',
+    'MARSHALLINGERROR': 'MarshallingErrorException',
+    'UNIMPLEMENTED': 'UnimplementedException',
+    'OPERATIONTIMEOUT': 'OperationTimeoutException',
+    'BADARGUMENTS': 'BadArgumentsException',
+    'INVALIDSTATE': 'InvalidStateException',
+    'APIERROR': 'ApiErrorException',
+    'NONODE': 'NoNodeException',
+    'NOAUTH': 'NoAuthException',
+    'BADVERSION': 'BadVersionException',
+    'NOCHILDRENFOREPHEMERALS': 'NoChildrenForEphemeralsException',
+    'NODEEXISTS': 'NodeExistsException',
+    'NOTEMPTY': 'NotEmptyException',
+    'SESSIONEXPIRED': 'SessionExpiredException',
+    'INVALIDCALLBACK': 'InvalidCallbackException',
+    'INVALIDACL': 'InvalidACLException',
+    'AUTHFAILED': 'AuthFailedException',
+    'CLOSING': 'ClosingException',
+    'NOTHING': 'NothingException',
+    'SESSIONMOVED': 'SessionMovedException'
+}
+
+
+class BindingBackend(Backend):
+    """Production backend using the ZooKeeper C binding"""
+
+    def __init__(self):
+        """Map binding exceptions to conveyor.zookeeper exceptions"""
+
+        binding.set_debug_level(0)
+
+        self.exceptions = {}
+        for name in dir(binding):
+            value = getattr(binding, name)
+            if isinstance(value, type) and issubclass(value, binding.ZooKeeperException):
+                self.exceptions[value] = getattr(zookeeper, name, zookeeper.ZooKeeperException)
+
+        # asynchronous calls report errors as return codes
+        self.error_codes = {}
+        for name, exception in ERROR_CODES.items():
+            if hasattr(binding, name):
+                self.error_codes[getattr(binding, name)] = getattr(zookeeper, exception)
+
+    def init(self, servers, watcher=None, timeout=10000, clientid=None):
+        if clientid:
+            return self.__call(binding.init, servers, watcher, timeout, clientid)
+        else:
+            return self.__call(binding.init, servers, watcher, timeout)
+
+    def close(self, handle):
+        return self.__call(binding.close, handle)
+
+    def client_id(self, handle):
+        return self.__call(binding.client_id, handle)
+
+    def state(self, handle):
+        return self.__call(binding.state, handle)
+
+    def create(self, handle, path, data, acl, flags):
+        return self.__call(binding.create, handle, path, data, acl, flags)
+
+    def get(self, handle, path, watcher=None):
+        return self.__call(binding.get, handle, path, watcher)
+
+    def set(self, handle, path, data, version=-1):
+        return self.__call(binding.set, handle, path, data, version)
+
+    def get_children(self, handle, path, watcher=None):
+        return self.__call(binding.get_children, handle, path, watcher)
+
+    def exists(self, handle, path, watcher=None):
+        return self.__call(binding.exists, handle, path, watcher)
+
+    def delete(self, handle, path, version=-1):
+        return self.__call(binding.delete, handle, path, version)
+
+    def aget(self, handle, path, completion, watcher=None):
+        return self.__call(binding.aget, handle, path, watcher, lambda h, rc, data, stat: completion(h, self.__error(rc), rc == binding.OK and (data, stat) or None))
+
+    def aget_children(self, handle, path, completion, watcher=None):
+        return self.__call(binding.aget_children, handle, path, watcher, lambda h, rc, children: completion(h, self.__error(rc), rc == binding.OK and children or None))
+
+    def aexists(self, handle, path, completion, watcher=None):
+        # like exists(), a missing node is not an error
+        return self.__call(binding.aexists, handle, path, watcher, lambda h, rc, stat: completion(h, rc != binding.NONODE and self.__error(rc) or None, rc == binding.OK and stat or None))
+
+    def deterministic_conn_order(self, value):
+        return binding.deterministic_conn_order(value)
+
+    def __error(self, rc):
+        """Return the exception for the return code of an asynchronous call (or None if it succeeded)"""
+
+        if rc == binding.OK:
+            return None
+        return self.error_codes.get(rc, zookeeper.ZooKeeperException)(binding.zerror(rc))
+
+    def __call(self, function, *args):
+        """Call a binding function, translating its exceptions"""
+
+        try:
+            return function(*args)
+        except binding.ZooKeeperException, e:
+            exception = self.exceptions.get(e.__class__, zookeeper.ZooKeeperException)
+            raise exception, exception(*e.args), sys.exc_info()[2]
@@ -0,0 +1,589 @@
+from __future__ import absolute_import
+
+import Queue
+import itertools
+import logging
+import os
+import threading
+import time
+
+from . import Backend
+from .. import zookeeper
+
+
+class Znode(object):
+    """A node stored by the in-memory server"""
+
+    def __init__(self, data, zxid, ephemeral_owner=0):
+        """Create a node at the given transaction id"""
+
+        now = int(time.time() * 1000)
+
+        self.data = data
+        self.children = set()
+        self.stat = {
+            'czxid': zxid,
+            'mzxid': zxid,
+            'pzxid': zxid,
+            'ctime': now,
+            'mtime': now,
+            'version': 0,
+            'cversion': 0,
+            'aversion': 0,
+            'ephemeralOwner': ephemeral_owner,
+            'dataLength': len(data),
+            'numChildren': 0
+        }
+
+    def copy(self):
+        """Return a copy of the node (for rolling back a transaction)"""
+
+        node = Znode.__new__(Znode)
+        node.data = self.data
+        node.children = set(self.children)
+        node.stat = dict(self.stat)
+        return node
+
+
+class Session(object):
+    """A client session on the in-memory server"""
+
+    def __init__(self, id, passwd, timeout, chroot):
+        """Create a connected session"""
+
+        self.id = id
+        self.passwd = passwd
+        self.timeout = timeout
+        self.chroot = chroot
+        self.state = zookeeper.CONNECTED_STATE
+        self.ephemerals = set()
+        self.handles = set()
+        self.deferred = []
+
+
+class Handle(object):
+    """A client connection to a session, with its own event thread (like the C client's completion thread)"""
+
+    def __init__(self, id, session, watcher):
+        """Start the event thread"""
+
+        self.id = id
+        self.session = session
+        self.watcher = watcher
+        self.events = Queue.Queue()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.__dispatch, name='memory-zookeeper-%d' % id)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def notify(self, watcher, type, state, path):
+        """Queue an event for delivery on the event thread"""
+
+        self.events.put((watcher, (self.id, type, state, path)))
+
+    def complete(self, completion, error, result):
+        """Queue the completion of an asynchronous call for delivery on the event thread"""
+
+        self.events.put((completion, (self.id, error, result)))
+
+    def stop(self):
+        """Stop the event thread once all queued events have been delivered"""
+
+        self.closed = True
+        self.events.put(None)
+
+    def __dispatch(self):
+        """Deliver events and completions in order"""
+
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            function, args = event
+            try:
+                function(*args)
+            except Exception, e:
+                logging.getLogger().exception(e)
+
+
+class MemoryBackend(Backend):
+    """In-memory stand-in for a ZooKeeper ensemble (for tests and benchmarks)
+
+    All sessions opened through one backend instance share one tree, regardless of the server list. Chroot suffixes are
+    honoured. Sessions never time out on their own; use expire(), disconnect() and reconnect() to simulate failures.
+
+    multi() is implemented, but like the ZooKeeper C binding the backend reports no transaction support by default, so
+    callers take the same path as in production. Set supports_multi to True to use transactions.
+    """
+
+    def __init__(self):
+        """Create an empty tree"""
+
+        self.lock = threading.RLock()
+        self.zxid = 0
+        self.nodes = {'/': Znode('', 0)}
+        self.sessions = {}
+        self.handles = {}
+        self.data_watches = {}
+        self.child_watches = {}
+        self.session_ids = itertools.count(0x100)
+        self.handle_ids = itertools.count(0)
+        self.triggers = None
+
+    def init(self, servers, watcher=None, timeout=10000, clientid=None):
+        self.lock.acquire()
+        try:
+            chroot = ''
+            if '/' in servers:
+                chroot = '/' + servers.split('/', 1)[1].strip('/')
+                if chroot == '/':
+                    chroot = ''
+
+            session = None
+            if clientid and clientid[0]:
+                session = self.sessions.get(clientid[0])
+                if session and session.passwd != clientid[1]:
+                    session = None
+            else:
+                session = Session(self.session_ids.next(), os.urandom(16), timeout, chroot)
+                self.sessions[session.id] = session
+                if chroot:
+                    self.__create_r(chroot)
+
+            handle = Handle(self.handle_ids.next(), session, watcher)
+            self.handles[handle.id] = handle
+
+            if session:
+                session.handles.add(handle.id)
+                self.__session_event(handle, zookeeper.CONNECTED_STATE)
+            else:
+                # the session we tried to resume is gone
+                handle.session = Session(clientid[0], clientid[1], timeout, chroot)
+                handle.session.state = zookeeper.EXPIRED_SESSION_STATE
+                self.__session_event(handle, zookeeper.EXPIRED_SESSION_STATE)
+
+            return handle.id
+        finally:
+            self.lock.release()
+
+    def close(self, handle):
+        self.lock.acquire()
+        try:
+            handle = self.__handle(handle, check_state=False)
+            session = handle.session
+
+            if session.id in self.sessions:
+                self.__end_session(session)
+
+            self.handles.pop(handle.id, None)
+            handle.stop()
+            return 0
+        finally:
+            self.lock.release()
+
+    def client_id(self, handle):
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle, check_state=False).session
+            return (session.id, session.passwd)
+        finally:
+            self.lock.release()
+
+    def state(self, handle):
+        self.lock.acquire()
+        try:
+            return self.__handle(handle, check_state=False).session.state
+        finally:
+            self.lock.release()
+
+    def create(self, handle, path, data, acl, flags):
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle).session
+            path = self.__path(session, path)
+
+            if flags & zookeeper.SEQUENCE:
+                parent = self.nodes.get(self.__parent(path))
+                if parent:
+                    path = '%s%010d' % (path, parent.stat['cversion'])
+
+            owner = 0
+            if flags & zookeeper.EPHEMERAL:
+                owner = session.id
+
+            self.__create(path, data, owner)
+            return self.__relative(session, path)
+        finally:
+            self.lock.release()
+
+    def get(self, handle, path, watcher=None):
+        self.lock.acquire()
+        try:
+            handle = self.__handle(handle)
+            path = self.__path(handle.session, path)
+            node = self.__node(path)
+
+            if watcher:
+                self.__watch(self.data_watches, path, handle, watcher)
+
+            return (node.data, dict(node.stat))
+        finally:
+            self.lock.release()
+
+    def set(self, handle, path, data, version=-1):
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle).session
+            path = self.__path(session, path)
+            node = self.__node(path)
+
+            if version != -1 and version != node.stat['version']:
+                raise zookeeper.BadVersionException('version conflict')
+
+            data = self.__data(data)
+            node.data = data
+            node.stat['version'] += 1
+            node.stat['mzxid'] = self.__next_zxid()
+            node.stat['mtime'] = int(time.time() * 1000)
+            node.stat['dataLength'] = len(data)
+
+            self.__trigger(self.data_watches, path, zookeeper.CHANGED_EVENT)
+            return 0
+        finally:
+            self.lock.release()
+
+    def get_children(self, handle, path, watcher=None):
+        self.lock.acquire()
+        try:
+            handle = self.__handle(handle)
+            path = self.__path(handle.session, path)
+            node = self.__node(path)
+
+            if watcher:
+                self.__watch(self.child_watches, path, handle, watcher)
+
+            return list(node.children)
+        finally:
+            self.lock.release()
+
+    def exists(self, handle, path, watcher=None):
+        self.lock.acquire()
+        try:
+            handle = self.__handle(handle)
+            path = self.__path(handle.session, path)
+
+            if watcher:
+                self.__watch(self.data_watches, path, handle, watcher)
+
+            node = self.nodes.get(path)
+            return node and dict(node.stat)
+        finally:
+            self.lock.release()
+
+    def delete(self, handle, path, version=-1):
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle).session
+            path = self.__path(session, path)
+            node = self.__node(path)
+
+            if version != -1 and version != node.stat['version']:
+                raise zookeeper.BadVersionException('version conflict')
+
+            if node.children:
+                raise zookeeper.NotEmptyException('not empty')
+
+            self.__delete(path)
+            return 0
+        finally:
+            self.lock.release()
+
+    def aget(self, handle, path, completion, watcher=None):
+        self.__complete(handle, completion, self.get, handle, path, watcher)
+
+    def aget_children(self, handle, path, completion, watcher=None):
+        self.__complete(handle, completion, self.get_children, handle, path, watcher)
+
+    def aexists(self, handle, path, completion, watcher=None):
+        self.__complete(handle, completion, self.exists, handle, path, watcher)
+
+    supports_multi = False
+
+    def multi(self, handle, ops):
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle).session
+
+            # apply the operations with watches held back, and roll everything back if one of them fails
+            zxid = self.zxid
+            ephemerals = dict((id, set(s.ephemerals)) for id, s in self.sessions.items())
+            touched = {}
+            self.triggers = []
+            try:
+                results = []
+                for op in ops:
+                    if op[0] in ('create', 'set', 'delete'):
+                        path = self.__path(session, op[1])
+                        for p in (path, self.__parent(path)):
+                            if p not in touched:
+                                touched[p] = p in self.nodes and self.nodes[p].copy() or None
+
+                    if op[0] == 'create':
+                        results.append(self.create(handle, *op[1:]))
+                        touched.setdefault(self.__path(session, results[-1]), None)
+                    elif op[0] == 'set':
+                        results.append(self.set(handle, *op[1:]))
+                    elif op[0] == 'delete':
+                        results.append(self.delete(handle, *op[1:]))
+                    elif op[0] == 'check':
+                        node = self.__node(self.__path(session, op[1]))
+                        if op[2] != -1 and op[2] != node.stat['version']:
+                            raise zookeeper.BadVersionException('version conflict')
+                        results.append(0)
+                    else:
+                        raise zookeeper.BadArgumentsException('bad arguments')
+
+            except:
+                self.zxid = zxid
+                for p, node in touched.items():
+                    if node is None:
+                        self.nodes.pop(p, None)
+                    else:
+                        self.nodes[p] = node
+                for id, paths in ephemerals.items():
+                    self.sessions[id].ephemerals = paths
+                self.triggers = None
+                raise
+
+            triggers, self.triggers = self.triggers, None
+            for watches, path, type in triggers:
+                self.__trigger(watches, path, type)
+
+            return results
+        finally:
+            self.lock.release()
+
+    def expire(self, handle):
+        """Expire a session, as the server does when it hasn't heard from the client within the session timeout"""
+
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle, check_state=False).session
+            if session.id not in self.sessions:
+                return
+
+            for id in session.handles:
+                if id in self.handles:
+                    self.__session_event(self.handles[id], zookeeper.EXPIRED_SESSION_STATE)
+
+            self.__end_session(session)
+        finally:
+            self.lock.release()
+
+    def disconnect(self, handle):
+        """Simulate a lost connection (watch events are held back until reconnect() is called)"""
+
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle).session
+            session.state = zookeeper.CONNECTING_STATE
+            for id in session.handles:
+                if id in self.handles:
+                    self.__session_event(self.handles[id], zookeeper.CONNECTING_STATE)
+        finally:
+            self.lock.release()
+
+    def reconnect(self, handle):
+        """Simulate re-establishing a lost connection within the session timeout"""
+
+        self.lock.acquire()
+        try:
+            session = self.__handle(handle, check_state=False).session
+            if session.state != zookeeper.CONNECTING_STATE:
+                return
+
+            session.state = zookeeper.CONNECTED_STATE
+            for id in session.handles:
+                if id in self.handles:
+                    self.__session_event(self.handles[id], zookeeper.CONNECTED_STATE)
+
+            deferred, session.deferred = session.deferred, []
+            for handle, watcher, type, path in deferred:
+                handle.notify(watcher, type, zookeeper.CONNECTED_STATE, path)
+        finally:
+            self.lock.release()
+
+    def __complete(self, handle, completion, function, *args):
+        """Run a call and queue its completion on the handle's event thread (as the C client does)"""
+
+        self.lock.acquire()
+        try:
+            target = self.__handle(handle, check_state=False)
+            try:
+                result = function(*args)
+            except zookeeper.ZooKeeperException, e:
+                target.complete(completion, e, None)
+            else:
+                target.complete(completion, None, result)
+        finally:
+            self.lock.release()
+
+    def __handle(self, id, check_state=True):
+        """Return a handle (raising if its session is unusable)"""
+
+        try:
+            handle = self.handles[id]
+        except KeyError:
+            raise zookeeper.ZooKeeperException('zhandle out of range')
+
+        if check_state:
+            if handle.session.state == zookeeper.EXPIRED_SESSION_STATE:
+                raise zookeeper.SessionExpiredException('session expired')
+            if handle.session.state != zookeeper.CONNECTED_STATE:
+                raise zookeeper.ConnectionLossException('connection loss')
+
+        return handle
+
+    def __path(self, session, path):
+        """Validate a path and return it with the session's chroot prepended"""
+
+        if not isinstance(path, basestring) or not path.startswith('/') or (path != '/' and path.endswith('/')) or '//' in path:
+            raise zookeeper.BadArgumentsException('bad arguments')
+
+        if session.chroot:
+            path = (session.chroot + path).rstrip('/') or '/'
+
+        return path
+
+    def __relative(self, session, path):
+        """Strip the session's chroot from a path"""
+
+        if session.chroot:
+            path = path[len(session.chroot):] or '/'
+        return path
+
+    def __parent(self, path):
+        """Return the parent of an absolute path"""
+
+        return path.rsplit('/', 1)[0] or '/'
+
+    def __node(self, path):
+        """Return a node (raising if it doesn't exist)"""
+
+        try:
+            return self.nodes[path]
+        except KeyError:
+            raise zookeeper.NoNodeException('no node')
+
+    def __data(self, data):
+        """Normalize node data"""
+
+        if data is None:
+            data = ''
+        if not isinstance(data, str):
+            raise zookeeper.BadArgumentsException('bad arguments')
+        return data
+
+    def __next_zxid(self):
+        """Return the next transaction id"""
+
+        self.zxid += 1
+        return self.zxid
+
+    def __create(self, path, data, owner):
+        """Create a node and fire the appropriate watches"""
+
+        if path in self.nodes:
+            raise zookeeper.NodeExistsException('node exists')
+
+        parent_path = self.__parent(path)
+        parent = self.__node(parent_path)
+        if parent.stat['ephemeralOwner']:
+            raise zookeeper.NoChildrenForEphemeralsException('no children for ephemerals')
+
+        zxid = self.__next_zxid()
+        self.nodes[path] = Znode(self.__data(data), zxid, owner)
+        if owner:
+            self.sessions[owner].ephemerals.add(path)
+
+        parent.children.add(path.rsplit('/', 1)[1])
+        parent.stat['cversion'] += 1
+        parent.stat['pzxid'] = zxid
+        parent.stat['numChildren'] = len(parent.children)
+
+        self.__trigger(self.data_watches, path, zookeeper.CREATED_EVENT)
+        self.__trigger(self.child_watches, parent_path, zookeeper.CHILD_EVENT)
+
+    def __create_r(self, path):
+        """Create a node and its parents (used for chroots)"""
+
+        if path not in self.nodes:
+            self.__create_r(self.__parent(path))
+            self.__create(path, '', 0)
+
+    def __delete(self, path):
+        """Delete a node and fire the appropriate watches"""
+
+        node = self.nodes.pop(path)
+        if node.stat['ephemeralOwner'] in self.sessions:
+            self.sessions[node.stat['ephemeralOwner']].ephemerals.discard(path)
+
+        parent_path = self.__parent(path)
+        parent = self.nodes[parent_path]
+        parent.children.discard(path.rsplit('/', 1)[1])
+        parent.stat['cversion'] += 1
+        parent.stat['pzxid'] = self.__next_zxid()
+        parent.stat['numChildren'] = len(parent.children)
+
+        self.__trigger(self.data_watches, path, zookeeper.DELETED_EVENT)
+        self.__trigger(self.child_watches, path, zookeeper.DELETED_EVENT)
+        self.__trigger(self.child_watches, parent_path, zookeeper.CHILD_EVENT)
+
+    def __end_session(self, session):
+        """Delete a session's ephemeral nodes and forget its watches"""
+
+        session.state = zookeeper.EXPIRED_SESSION_STATE
+        self.sessions.pop(session.id, None)
+
+        for path in sorted(session.ephemerals, reverse=True):
+            if path in self.nodes:
+                self.__delete(path)
+
+        for watches in (self.data_watches, self.child_watches):
+            for path in watches.keys():
+                watches[path] = [w for w in watches[path] if w[0].session is not session]
+                if not watches[path]:
+                    del watches[path]
+
+    def __watch(self, watches, path, handle, watcher):
+        """Register a one-time watch"""
+
+        watches.setdefault(path, []).append((handle, watcher))
+
+    def __trigger(self, watches, path, type):
+        """Fire (and remove) the watches set on a path"""
+
+        if self.triggers is not None:
+            self.triggers.append((watches, path, type))
+            return
+
+        for handle, watcher in watches.pop(path, []):
+            session = handle.session
+            relative = self.__relative(session, path)
+            if session.state == zookeeper.CONNECTED_STATE:
+                handle.notify(watcher, type, zookeeper.CONNECTED_STATE, relative)
+            elif session.state == zookeeper.CONNECTING_STATE:
+                session.deferred.append((handle, watcher, type, relative))
+
+    def __session_event(self, handle, state):
+        """Deliver a session event to the global watcher and (like the C client) to every registered watcher"""
+
+        if handle.watcher:
+            handle.notify(handle.watcher, zookeeper.SESSION_EVENT, state, '')
+
+        for watches in (self.data_watches, self.child_watches):
+            for path, registered in watches.items():
+                for h, watcher in registered:
+                    if h is handle:
+                        handle.notify(watcher, zookeeper.SESSION_EVENT, state, '')
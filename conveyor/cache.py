@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from . import zookeeper
+
+
+class NodeCache(object):
+    """In-memory mirror of ZooKeeper nodes, kept current by watches"""
+
+    def __init__(self):
+        """Create an empty cache"""
+
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.children = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, handle, path):
+        """Return a (data, stat) tuple, reading from ZooKeeper only if the cached copy may be stale"""
+
+        return self.__lookup(self.nodes, handle, path, zookeeper.get, self.__data_watcher)
+
+    def get_children(self, handle, path):
+        """Return a list of child nodes, reading from ZooKeeper only if the cached copy may be stale"""
+
+        return list(self.__lookup(self.children, handle, path, zookeeper.get_children, self.__child_watcher))
+
+    def invalidate(self, path):
+        """Forget a node, its children and the children of its parent (call after writing to it)"""
+
+        self.lock.acquire()
+        try:
+            for p in (path, zookeeper.get_parent_node(path)):
+                self.generations[p] = self.generations.get(p, 0) + 1
+            self.nodes.pop(path, None)
+            self.children.pop(path, None)
+            self.children.pop(zookeeper.get_parent_node(path), None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Forget everything (e.g. when the session and its watches are gone)"""
+
+        self.lock.acquire()
+        try:
+            for path in set(self.nodes.keys() + self.children.keys()):
+                self.generations[path] = self.generations.get(path, 0) + 1
+            self.nodes.clear()
+            self.children.clear()
+        finally:
+            self.lock.release()
+
+    def __lookup(self, entries, handle, path, read, watcher):
+        """Return a cached entry, or read it with a watch and cache it"""
+
+        self.lock.acquire()
+        try:
+            if path in entries:
+                self.hits += 1
+                return entries[path]
+            self.misses += 1
+            generation = self.generations.get(path, 0)
+        finally:
+            self.lock.release()
+
+        result = read(handle, path, watcher)
+
+        # only cache the result if the watch didn't fire while we were reading
+        self.lock.acquire()
+        try:
+            if self.generations.get(path, 0) == generation:
+                entries[path] = result
+        finally:
+            self.lock.release()
+
+        return result
+
+    def __data_watcher(self, handle, type, state, path):
+        """Drop a node when its data changes"""
+
+        if type == zookeeper.SESSION_EVENT:
+            self.__session_event(state)
+        else:
+            logging.getLogger().debug('Cached node changed: type=%s, path=%s', type, path)
+            self.__forget(self.nodes, path)
+
+    def __child_watcher(self, handle, type, state, path):
+        """Drop a child list when children are added or removed"""
+
+        if type == zookeeper.SESSION_EVENT:
+            self.__session_event(state)
+        else:
+            logging.getLogger().debug('Cached children changed: type=%s, path=%s', type, path)
+            self.__forget(self.children, path)
+
+    def __session_event(self, state):
+        """Forget everything once the session has expired"""
+
+        if state == zookeeper.EXPIRED_SESSION_STATE:
+            self.clear()
+
+    def __forget(self, entries, path):
+        """Drop a single entry"""
+
+        self.lock.acquire()
+        try:
+            self.generations[path] = self.generations.get(path, 0) + 1
+            entries.pop(path, None)
+        finally:
+            self.lock.release()
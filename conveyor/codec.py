@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+import zlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+MAGIC = '\x00cv'
+FORMAT_ZLIB = '\x01'
+COMPRESS_MIN = None
+COMPRESS_LEVEL = 6
+
+
+class DecodeError(ValueError):
+    """Exception raised when node data cannot be decoded"""
+
+
+def encode(data, defaults=None, compress_min=None):
+    """Serialize node data
+
+    Fields equal to their default value are left out, and the JSON is written without whitespace. Payloads of at
+    least compress_min bytes (COMPRESS_MIN by default, None disables compression) are compressed with zlib behind
+    a MAGIC header. Uncompressed payloads are plain JSON, which any version of conveyor can read.
+    """
+
+    if defaults and isinstance(data, dict):
+        data = dict((name, value) for name, value in data.items() if name not in defaults or defaults[name] != value)
+
+    result = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    if isinstance(result, unicode):
+        result = result.encode('utf-8')
+
+    if compress_min is None:
+        compress_min = COMPRESS_MIN
+    if compress_min is not None and len(result) >= compress_min:
+        result = MAGIC + FORMAT_ZLIB + zlib.compress(result, COMPRESS_LEVEL)
+
+    return result
+
+
+def decode(value):
+    """Deserialize node data written by encode() (or plain JSON written by older versions)
+
+    Raises DecodeError if the value cannot be decoded. Fields left out by encode() are filled in by the node classes.
+    """
+
+    try:
+        if value.startswith(MAGIC):
+            format = value[len(MAGIC):len(MAGIC) + 1]
+            if format != FORMAT_ZLIB:
+                raise DecodeError('Unknown node data format: %r' % format)
+            value = zlib.decompress(value[len(MAGIC) + 1:])
+        return json.loads(value)
+    except DecodeError:
+        raise
+    except (AttributeError, TypeError, ValueError, zlib.error), e:
+        raise DecodeError(str(e))
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+
+import logging
+
+from . import nodes
+from . import zookeeper
+
+
+def path_for(group, app_id=None):
+    """Return the path of an application's entry in a group index (or of the index itself if app_id is omitted)"""
+
+    return zookeeper.path_join('groups', group, 'applications', app_id)
+
+
+def groups_of(handle, app_id):
+    """Return the groups an application node currently belongs to (an empty list if it doesn't exist)"""
+
+    try:
+        data = nodes.Node.read(handle=handle, path=zookeeper.path_join('applications', app_id)).data
+    except zookeeper.NoNodeException:
+        return []
+
+    return isinstance(data, dict) and data.get('groups') or []
+
+
+def update(handle, application, previous_groups=()):
+    """Add an application to the index of each of its groups, and remove it from the groups it no longer belongs to"""
+
+    groups = set(application.data['groups'])
+
+    for group in sorted(groups):
+        try:
+            zookeeper.create_r(handle, path_for(group, application.id))
+        except zookeeper.NodeExistsException:
+            pass
+
+    remove(handle=handle, app_id=application.id, groups=set(previous_groups) - groups)
+
+
+def remove(handle, app_id, groups):
+    """Remove an application from the index of the specified groups"""
+
+    for group in sorted(groups):
+        try:
+            zookeeper.delete(handle, path_for(group, app_id))
+        except zookeeper.NoNodeException:
+            pass
+
+
+def rebuild(handle):
+    """Bring the index of every group in line with the application nodes
+
+    Returns an {'added', 'removed'} dict of "group/application" entries.
+    """
+
+    wanted = set()
+    for app_id in nodes.list_children(handle=handle, path=zookeeper.path_join('applications')):
+        try:
+            application = nodes.Application.read(handle=handle, path=zookeeper.path_join('applications', app_id))
+        except zookeeper.NoNodeException:
+            continue
+        if application.data is not None:
+            wanted.update([(group, app_id) for group in application.data['groups']])
+
+    indexed = set()
+    try:
+        groups = zookeeper.get_children(handle, zookeeper.path_join('groups'))
+    except zookeeper.NoNodeException:
+        groups = []
+    for group in groups:
+        try:
+            indexed.update([(group, app_id) for app_id in zookeeper.get_children(handle, path_for(group))])
+        except zookeeper.NoNodeException:
+            pass
+
+    for group, app_id in sorted(wanted - indexed):
+        try:
+            zookeeper.create_r(handle, path_for(group, app_id))
+        except zookeeper.NodeExistsException:
+            pass
+
+    for group, app_id in sorted(indexed - wanted):
+        try:
+            zookeeper.delete(handle, path_for(group, app_id))
+        except zookeeper.NoNodeException:
+            pass
+
+    logging.getLogger().info('Rebuilt group index: %d entries added, %d removed', len(wanted - indexed), len(indexed - wanted))
+    return {'added': ['%s/%s' % entry for entry in sorted(wanted - indexed)], 'removed': ['%s/%s' % entry for entry in sorted(indexed - wanted)]}
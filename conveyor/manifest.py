@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import json
+import logging
+
+from . import index
+from . import nodes
+from . import zookeeper
+
+
+MULTI_BATCH = 50
+RUNTIME_FIELDS = ('slots', 'failures', 'publish_id')
+
+
+def load(path):
+    """Read a manifest file and return a dict of application definitions keyed by name
+
+    A manifest is a JSON object of the form {"applications": {"NAME": {"version": ..., ...}, ...}}. Option names may
+    use dashes or underscores, and groups may be a list or a comma-separated string.
+    """
+
+    f = open(path)
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('applications'), dict):
+        raise ValueError('%s: manifest must contain an "applications" object' % path)
+
+    applications = {}
+    for name, definition in manifest['applications'].items():
+        if not isinstance(definition, dict) or 'version' not in definition:
+            raise ValueError('%s: application %s must be an object with a version' % (path, name))
+        definition = dict(definition)
+        if isinstance(definition.get('groups'), list):
+            definition['groups'] = ', '.join(definition['groups'])
+        applications[name] = definition
+    return applications
+
+
+def changed(current, wanted):
+    """Return True if two applications differ in anything but their runtime fields (slots, failures and publish id)"""
+
+    names = (set(current.data) | set(wanted.data)) - set(RUNTIME_FIELDS)
+    return any(current.data.get(name) != wanted.data.get(name) for name in names)
+
+
+def apply(handle, applications, batch=MULTI_BATCH):
+    """Create or update application nodes so they match a list of applications
+
+    Only new and changed applications are written, in transactions of up to batch operations. Changed applications
+    are written with the version they were read at, so a concurrent update fails the transaction with
+    BadVersionException (already committed transactions are kept, and applying again picks up where it stopped).
+    Written applications get a new publish id, so they start over with no recorded results (their failure count is
+    reset too), and the group index is updated for new applications and those whose groups changed. Applications that are not listed are left alone.
+    Returns a {'created', 'updated', 'unchanged'} dict of names.
+    """
+
+    if not zookeeper.exists(handle, zookeeper.path_join('applications')):
+        zookeeper.create_r(handle, zookeeper.path_join('applications'))
+
+    summary = {'created': [], 'updated': [], 'unchanged': []}
+    ops = []
+    written = []
+    previous_groups = {}
+
+    for application in sorted(applications, key=lambda a: a.id):
+        try:
+            current = nodes.Application.read(handle=handle, path=application.path)
+        except zookeeper.NoNodeException:
+            application.data['publish_id'] = nodes.Application.new_publish_id()
+            ops.append(zookeeper.create_op(application.path, application.encode()))
+            summary['created'].append(application.id)
+            previous_groups[application.id] = None
+        else:
+            if current.data is not None and not changed(current, application):
+                summary['unchanged'].append(application.id)
+                continue
+            application.data['publish_id'] = nodes.Application.new_publish_id()
+            ops.append(zookeeper.set_op(application.path, application.encode(), current.version))
+            summary['updated'].append(application.id)
+            previous_groups[application.id] = current.data and current.data['groups'] or []
+        written.append(application)
+
+    for i in range(0, len(ops), batch):
+        logging.getLogger().debug('Writing %d application(s)', len(ops[i:i + batch]))
+        zookeeper.transaction(handle, ops[i:i + batch])
+
+    for application in written:
+        previous = previous_groups[application.id]
+        if previous is None or set(previous) != set(application.data['groups']):
+            index.update(handle=handle, application=application, previous_groups=previous or [])
+
+    logging.getLogger().info('Applied %d application(s): %d created, %d updated, %d unchanged', len(applications), len(summary['created']), len(summary['updated']), len(summary['unchanged']))
+    return summary
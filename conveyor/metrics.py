@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+
+
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+
+def format_value(value):
+    """Format a sample value"""
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    """Format a set of label names and values"""
+
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+class Metric(object):
+    """Base class for all metrics"""
+
+    type = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        """Create a metric with the given label names (function, if specified, returns a list of (label values, value) tuples when collected)"""
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def render(self):
+        """Return the metric in the Prometheus text format"""
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labels, value in sorted(self.samples()):
+            lines.append('%s%s %s' % (self.name, format_labels(self.labels, labels), format_value(value)))
+        return lines
+
+    def samples(self):
+        """Return a list of (label values, value) tuples"""
+
+        if self.function:
+            return [(tuple(labels), value) for labels, value in self.function()]
+
+        self.lock.acquire()
+        try:
+            return self.values.items()
+        finally:
+            self.lock.release()
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """Increment the counter"""
+
+        labels = tuple(labels)
+        self.lock.acquire()
+        try:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        finally:
+            self.lock.release()
+
+
+class Gauge(Metric):
+    """A value that can go up and down, or that is computed when collected"""
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        """Set the gauge"""
+
+        labels = tuple(labels)
+        self.lock.acquire()
+        try:
+            self.values[labels] = value
+        finally:
+            self.lock.release()
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        """Create a histogram with the given upper bounds"""
+
+        super(Histogram, self).__init__(name=name, help=help, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """Record an observation"""
+
+        labels = tuple(labels)
+        self.lock.acquire()
+        try:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+        finally:
+            self.lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labels, (counts, total) in sorted(self.samples()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (self.name, format_labels(self.labels + ('le',), labels + (format_value(bound),)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, labels), format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, format_labels(self.labels, labels), cumulative))
+        return lines
+
+    def samples(self):
+        self.lock.acquire()
+        try:
+            return [(labels, (list(counts), total)) for labels, (counts, total) in self.values.items()]
+        finally:
+            self.lock.release()
+
+
+class Registry(object):
+    """A collection of metrics"""
+
+    def __init__(self):
+        """Create an empty registry"""
+
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry and return it"""
+
+        self.lock.acquire()
+        try:
+            self.metrics.append(metric)
+        finally:
+            self.lock.release()
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        """Create and register a counter"""
+
+        return self.register(Counter(name=name, help=help, labels=labels, function=function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        """Create and register a gauge"""
+
+        return self.register(Gauge(name=name, help=help, labels=labels, function=function))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        """Create and register a histogram"""
+
+        return self.register(Histogram(name=name, help=help, labels=labels, buckets=buckets))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+
+        self.lock.acquire()
+        try:
+            metrics = list(self.metrics)
+        finally:
+            self.lock.release()
+
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception, e:
+                logging.getLogger().exception(e)
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """HTTP listener serving a registry in the Prometheus text format"""
+
+    class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Metrics request handler"""
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = self.server.registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.getLogger().debug('Metrics request from %s: %s', self.client_address[0], format % args)
+
+    def __init__(self, address, registry):
+        """Bind to an (address, port) tuple"""
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, self.RequestHandler)
+        self.registry = registry
+
+    def start(self):
+        """Serve requests on a background thread"""
+
+        thread = threading.Thread(target=self.serve_forever, name='metrics-server')
+        thread.setDaemon(True)
+        thread.start()
+        logging.getLogger().info('Serving metrics on http://%s:%d/metrics', *self.server_address[:2])
+        return self
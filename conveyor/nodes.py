@@ -1,32 +1,137 @@
 from __future__ import absolute_import
 
-import json
+import collections
+import copy
 import logging
+import os
 import re
+import signal
 import subprocess
+import threading
+import time
+import urllib
+import uuid
 
+from . import codec
 from . import util
 from . import zookeeper
 
 
-def list_children(handle, path, watcher=None):
-    """Return a sorted list of child nodes from ZooKeeper"""
+CAS_BACKOFF = 0.01
+CAS_BACKOFF_MAX = 1.0
+COMMAND_OUTPUT_LINES = 100
+COMMAND_OUTPUT_LINE_MAX = 4096
+COMMAND_KILL_GRACE = 5
+BATCH_ITEM = '%(id)s=%(data[version])s'
+COMMAND_PLACEHOLDER = re.compile(r'%\((?:data\[(.+?)]|(.+?))\)s')
+COMMAND_TEMPLATES_MAX = 1024
 
-    result = sorted(zookeeper.get_children(handle, path, watcher))
+
+command_templates = {}
+
+
+def compile_command(command):
+    """Return a command template parsed into a tuple of (literal, data item, attribute) parts (cached per template)
+
+    Exactly one element of each part is not None. Templates are parsed once, so the placeholders are looked up
+    without any regular expression when a command is run.
+    """
+
+    try:
+        return command_templates[command]
+    except KeyError:
+        pass
+
+    template = []
+    position = 0
+    for match in COMMAND_PLACEHOLDER.finditer(command):
+        if match.start() > position:
+            template.append((command[position:match.start()], None, None))
+        template.append((None, match.group(1), match.group(2)))
+        position = match.end()
+    if position < len(command):
+        template.append((command[position:], None, None))
+    template = tuple(template)
+
+    # deploy workers share the cache, and another one may clear it at any time
+    if len(command_templates) >= COMMAND_TEMPLATES_MAX:
+        command_templates.clear()
+    command_templates[command] = template
+    return template
+
+
+def list_children(handle, path, watcher=None, cache=None):
+    """Return a sorted list of child nodes from ZooKeeper (or from the cache if no watcher is specified)"""
+
+    if cache and not watcher:
+        result = sorted(cache.get_children(handle, path))
+    else:
+        result = sorted(zookeeper.get_children(handle, path, watcher))
     logging.getLogger().debug('Listing children of %s: %s ', path, ', '.join(result))
     return result
 
 
-def delete(handle, path):
+class CasConflicts(object):
+    """Counts of compare-and-set conflicts per operation and node"""
+
+    def __init__(self):
+        """Create an empty set of counters"""
+
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, operation, path, conflicts):
+        """Record the number of conflicts that one operation on a node had to retry"""
+
+        self.lock.acquire()
+        try:
+            counts = self.counts.setdefault((operation, path), {'operations': 0, 'conflicts': 0, 'max_conflicts': 0})
+            counts['operations'] += 1
+            counts['conflicts'] += conflicts
+            counts['max_conflicts'] = max(counts['max_conflicts'], conflicts)
+        finally:
+            self.lock.release()
+
+        if conflicts:
+            logging.getLogger().info('%s of %s retried after %d version conflict(s)', operation.capitalize(), path, conflicts)
+
+    def snapshot(self):
+        """Return a copy of the counters keyed by (operation, path)"""
+
+        self.lock.acquire()
+        try:
+            return dict((key, dict(value)) for key, value in self.counts.items())
+        finally:
+            self.lock.release()
+
+
+cas_conflicts = CasConflicts()
+
+
+def cas_backoff(operation, path, conflicts):
+    """Sleep before retrying a compare-and-set that lost against a concurrent update"""
+
+    delay = util.backoff(conflicts, CAS_BACKOFF, CAS_BACKOFF_MAX)
+    logging.getLogger().debug('Version mismatch during %s of %s (retry %d in %.3f seconds)', operation, path, conflicts, delay)
+    time.sleep(delay)
+
+
+def delete(handle, path, cache=None):
     """Delete a node from ZooKeeper"""
 
     logging.getLogger().debug('Deleting %s', path)
-    return zookeeper.delete(handle, path)
+    try:
+        return zookeeper.delete(handle, path)
+    finally:
+        if cache:
+            cache.invalidate(path)
 
 
 class Node(object):
     """Base class for all nodes"""
 
+    DEFAULTS = {}
+
     def __init__(self, path, data={}, attrs={}):
         """Create a new node using the supplied data/attributes"""
 
@@ -37,16 +142,19 @@ class Node(object):
            setattr(self, name, value)
 
     @classmethod
-    def read(self, handle, path, watcher=None):
-        """Read a node from ZooKeeper"""
+    def read(self, handle, path, watcher=None, cache=None):
+        """Read a node from ZooKeeper (or from the cache if no watcher is specified)"""
 
-        node_tuple = zookeeper.get(handle, path, watcher)
+        if cache and not watcher:
+            node_tuple = cache.get(handle, path)
+        else:
+            node_tuple = zookeeper.get(handle, path, watcher)
         logging.getLogger().debug('Read instance of %s: %s %s', self.__name__, path, node_tuple)
 
         try:
-            data = json.loads(node_tuple[0])
-        except:
-            logging.getLogger().error('Unable to unserialize JSON from %s: %s', path, node_tuple[0])
+            data = codec.decode(node_tuple[0])
+        except codec.DecodeError, e:
+            logging.getLogger().error('Unable to decode data of %s (%s): %r', path, e, node_tuple[0])
             data = None
 
         return self(path=path, data=data, attrs=node_tuple[1])
@@ -79,26 +187,49 @@ class Node(object):
 
         return result
 
-    def write(self, handle, acl, flags, overwrite=True, overwrite_if_version=None):
+    def encode(self):
+        """Return the serialized data of this node (leaving out fields that have their default value)"""
+
+        return codec.encode(self.data, defaults=self.DEFAULTS)
+
+    @classmethod
+    def with_defaults(self, data):
+        """Return a copy of the fields of data known to this node class, filling in missing ones with their defaults"""
+
+        return dict((name, data.get(name, copy.copy(default))) for name, default in self.DEFAULTS.items())
+
+    def write(self, handle, acl, flags, overwrite=True, overwrite_if_version=None, cache=None):
         """Create a persistent node in ZooKeeper"""
 
+        try:
+            return self.__write(handle=handle, acl=acl, flags=flags, overwrite=overwrite, overwrite_if_version=overwrite_if_version)
+        finally:
+            if cache:
+                cache.invalidate(self.path)
+
+    def __write(self, handle, acl, flags, overwrite, overwrite_if_version):
+        """Create or update a node in ZooKeeper"""
+
         while True:
             try:
-                zookeeper.create(handle, self.path, json.dumps(self.data), acl, flags)
+                zookeeper.create(handle, self.path, self.encode(), acl, flags)
                 logging.getLogger().debug('Wrote instance of %s: %s (%s)', self.__class__.__name__, self.path, self.data)
                 break
             except zookeeper.NodeExistsException:
                 if overwrite:
-                    if overwrite_if_version:
-                        zookeeper.set(handle, self.path, json.dumps(self.data), overwrite_if_version)
+                    if overwrite_if_version is not None:
+                        zookeeper.set(handle, self.path, self.encode(), overwrite_if_version)
                     else:
-                        zookeeper.set(handle, self.path, json.dumps(self.data))
+                        zookeeper.set(handle, self.path, self.encode())
                     logging.getLogger().debug('Updated instance of %s: %s (%s)', self.__class__.__name__, self.path, self.data)
                     break
                 else:
                     raise
             except zookeeper.NoNodeException:
-                zookeeper.create_r(handle, zookeeper.get_parent_node(self.path), '', acl, zookeeper.PERSISTENT)
+                try:
+                    zookeeper.create_r(handle, zookeeper.get_parent_node(self.path), '', acl, zookeeper.PERSISTENT)
+                except zookeeper.NodeExistsException: # another client created the parent first
+                    pass
 
         return self
 
@@ -109,10 +240,10 @@ class EphemeralNode(Node):
     def __init__(self, path, data={}, attrs={}):
         super(EphemeralNode, self).__init__(path=path, data=data, attrs=attrs)
 
-    def write(self, handle, acl=[zookeeper.ZOO_OPEN_ACL_UNSAFE], overwrite=True, overwrite_if_version=None):
+    def write(self, handle, acl=[zookeeper.ZOO_OPEN_ACL_UNSAFE], overwrite=True, overwrite_if_version=None, cache=None):
         """Create an ephemeral node in ZooKeeper"""
 
-        return super(EphemeralNode, self).write(handle=handle, acl=acl, flags=zookeeper.EPHEMERAL, overwrite=overwrite, overwrite_if_version=overwrite_if_version)
+        return super(EphemeralNode, self).write(handle=handle, acl=acl, flags=zookeeper.EPHEMERAL, overwrite=overwrite, overwrite_if_version=overwrite_if_version, cache=cache)
 
 
 class PersistentNode(Node):
@@ -121,22 +252,24 @@ class PersistentNode(Node):
     def __init__(self, path, data={}, attrs={}):
         super(PersistentNode, self).__init__(path=path, data=data, attrs=attrs)
 
-    def write(self, handle, acl=[zookeeper.ZOO_OPEN_ACL_UNSAFE], overwrite=True, overwrite_if_version=None):
+    def write(self, handle, acl=[zookeeper.ZOO_OPEN_ACL_UNSAFE], overwrite=True, overwrite_if_version=None, cache=None):
         """Create a persistent node in ZooKeeper"""
 
-        return super(PersistentNode, self).write(handle=handle, acl=acl, flags=zookeeper.PERSISTENT, overwrite=overwrite, overwrite_if_version=overwrite_if_version)
+        return super(PersistentNode, self).write(handle=handle, acl=acl, flags=zookeeper.PERSISTENT, overwrite=overwrite, overwrite_if_version=overwrite_if_version, cache=cache)
 
 
 class Host(EphemeralNode):
     """Host node class"""
 
+    DEFAULTS = {
+        'groups': []
+    }
+
     def __init__(self, path, data={}, attrs={}):
 
         self.id = zookeeper.path_split(path)[-1]
 
-        data = {
-            'groups': data.get('groups', [])
-        }
+        data = self.with_defaults(data)
 
         super(Host, self).__init__(path=path, data=data, attrs=attrs)
 
@@ -153,30 +286,41 @@ class Application(PersistentNode):
     class CommandError(Exception):
         """Exception raised on command error"""
 
+    class CommandTimeout(CommandError):
+        """Exception raised when a command runs for too long"""
+
+    DEFAULTS = {
+        'groups': [],
+        'version': '0',
+        'slots': 1,
+        'slot_increment': 1,
+        'failed_max': 0,
+        'get_version_cmd': None,
+        'deploy_cmd': None,
+        'deploy_timeout': None,
+        'version_timeout': None,
+        'failures': 0,
+        'slot_mode': 'counter',
+        'batch_deploy_cmd': None,
+        'batch_item': None,
+        'get_version_argv': None,
+        'deploy_argv': None,
+        'publish_id': None
+    }
+
     def __init__(self, path, data={}, attrs={}):
 
         self.id = zookeeper.path_split(path)[-1]
 
-        data = {
-            'groups': data.get('groups', []),
-            'version': data.get('version', '0'),
-            'slots': data.get('slots', 1),
-            'slot_increment': data.get('slot_increment', 1),
-            'failed_max': data.get('failed_max', 0),
-            'get_version_cmd': data.get('get_version_cmd', None),
-            'deploy_cmd': data.get('deploy_cmd', None),
-            'successful': data.get('successful', []),
-            'failed': data.get('failed', []),
-            'skipped': data.get('skipped', [])
-        }
+        data = self.with_defaults(data)
 
         super(Application, self).__init__(path=path, data=data, attrs=attrs)
 
-    def deployment_slot_overflow(self, handle):
+    def deployment_slot_overflow(self, handle, cache=None):
         """Return True on deployment slot overflow"""
 
         result = False
-        if len(list_children(handle=handle, path=self.path)) > int(self.data['slots']):
+        if len(list_children(handle=handle, path=self.path, cache=cache)) > int(self.data['slots']):
             result = True
         return result
 
@@ -184,14 +328,14 @@ class Application(PersistentNode):
         """Return True if this application has exceeded the maximum number of deployment failures"""
 
         result = False
-        if len(self.data['failed']) > int(self.data['failed_max']):
+        if int(self.data['failures']) > int(self.data['failed_max']):
             result = True
         return result
 
-    def deployed(self, host_id):
+    def deployed(self, handle, host_id):
         """Return True if this application has already been deployed"""
 
-        if host_id in set(self.data['successful'] + self.data['failed'] + self.data['skipped']):
+        if zookeeper.exists(handle, DeploymentResult.path_for(self.id, self.results_key(), host_id)):
             logging.getLogger().debug('Deployment of %s %s has already been recorded for host %s', self.id, self.data['version'], host_id)
             result = True
         else:
@@ -200,21 +344,123 @@ class Application(PersistentNode):
 
         return result
 
-    def run_command(self, command):
-        """Run a command using this node's data/attributes"""
+    @staticmethod
+    def new_publish_id():
+        """Return a new publish id (written into an application each time it is published)"""
+
+        return uuid.uuid4().hex
+
+    def results_key(self):
+        """Return the name deployment results are recorded under (the publish id, or the version if there is none)
+
+        Every publish gets a new publish id, so publishing an application starts over with no recorded results
+        without deleting the results of earlier publishes (see delete_results).
+        """
+
+        return self.data['publish_id'] or self.data['version']
 
-        command = self.__interpolate(command)
+    def delete_results(self, handle, keep=None):
+        """Delete recorded deployment results (of every publish except keep) and return the names of the deleted ones"""
+
+        path = DeploymentResult.path_for(self.id)
+
+        try:
+            keys = zookeeper.get_children(handle, path)
+        except zookeeper.NoNodeException:
+            return []
+
+        deleted = []
+        for key in sorted(keys):
+            if keep is not None and key == DeploymentResult.quote(keep):
+                continue
+            try:
+                zookeeper.delete_r(handle, zookeeper.path_join(path, key, relative=True))
+                deleted.append(key)
+            except zookeeper.NoNodeException:
+                pass
+
+        if keep is None:
+            try:
+                delete(handle=handle, path=path)
+            except (zookeeper.NoNodeException, zookeeper.NotEmptyException): # a host already recorded a new result
+                pass
+
+        return deleted
+
+    def get_version_command(self):
+        """Return the command that prints the installed version (an argv list if get_version_argv is set)"""
+
+        return self.data['get_version_argv'] or self.data['get_version_cmd']
+
+    def deploy_command(self):
+        """Return the command that deploys this application (an argv list if deploy_argv is set)"""
+
+        return self.data['deploy_argv'] or self.data['deploy_cmd']
+
+    @classmethod
+    def run_batch_command(self, applications, output=None, timeout=None):
+        """Run the batch deploy command shared by a list of applications
+
+        The %(items)s placeholder of the command is replaced with each application's batch item (BATCH_ITEM by
+        default), e.g. "/usr/bin/aptitude install -y %(items)s" runs "/usr/bin/aptitude install -y a=1.0 b=2.0".
+        """
+
+        items = ' '.join([app.__interpolate(app.data['batch_item'] or BATCH_ITEM) for app in applications])
+        batch = self(path=applications[0].path, data=applications[0].data, attrs={'items': items})
+        return batch.run_command(batch.data['batch_deploy_cmd'], output=output, timeout=timeout)
+
+    def run_command(self, command, output=None, timeout=None):
+        """Run a command using this node's data/attributes
+
+        A command string is run by the shell. A list of arguments is executed directly (without a shell), after
+        interpolating each argument on its own. Output is logged (and copied to the optional output file) line by line as it is produced. Only the last
+        COMMAND_OUTPUT_LINES lines are kept in memory, and returned. The command runs in its own process group, which
+        is killed if the command is still running after timeout seconds.
+        """
+
+        if isinstance(command, list):
+            command = [self.__interpolate(arg) for arg in command]
+            shell = False
+        else:
+            command = self.__interpolate(command)
+            shell = True
         logging.getLogger().debug('Running command: %s', command)
 
         try:
-            p = subprocess.Popen(command, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-            result = p.communicate()[0].strip()
+            p = subprocess.Popen(command, shell=shell, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, preexec_fn=os.setsid)
 
-        except TypeError:
+        except (TypeError, OSError):
             logging.getLogger().warn('Command is not runnable: %s', command)
             raise Application.CommandError
 
         else:
+            timer = None
+            timed_out = threading.Event()
+            if timeout:
+                timer = threading.Timer(float(timeout), self.__kill, (p, command, timeout, timed_out))
+                timer.setDaemon(True)
+                timer.start()
+
+            tail = collections.deque(maxlen=COMMAND_OUTPUT_LINES)
+            try:
+                for line in iter(lambda: p.stdout.readline(COMMAND_OUTPUT_LINE_MAX), ''):
+                    tail.append(line)
+                    logging.getLogger().debug('%s: %s', self.id, line.rstrip('\n'))
+                    if output:
+                        output.write(line)
+                        output.flush()
+            finally:
+                p.stdout.close()
+                p.wait()
+                if timer:
+                    timer.cancel()
+                    timer.join()
+
+            result = ''.join(tail).strip()
+
+            if timed_out.isSet():
+                raise Application.CommandTimeout
+
             if p.returncode:
                 logging.getLogger().warn('Command result: %s (%d)', result, p.returncode)
                 raise Application.CommandError
@@ -223,35 +469,43 @@ class Application(PersistentNode):
 
             return result
 
-    def __interpolate(self, command):
-        """Do variable interpolation on a string using this node's data"""
+    def __kill(self, p, command, timeout, timed_out):
+        """Kill the process group of a command that has timed out"""
 
-        def get_attr(match_obj):
-            """Return an attribute value"""
+        timed_out.set()
+        logging.getLogger().error('Command timed out after %s seconds (killing process group %d): %s', timeout, p.pid, command)
 
-            item = match_obj.group(1)
-            if hasattr(self, item):
-                result = getattr(self, item)
-            else:
-                result = ''
-            return str(result)
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
 
-        def get_data(match_obj):
-            """Return a data value"""
+            deadline = time.time() + COMMAND_KILL_GRACE
+            while time.time() < deadline:
+                time.sleep(0.1)
+                os.killpg(p.pid, 0)
 
-            item = match_obj.group(1)
-            if item in self.data:
-                result = self.data[item]
-            else:
-                result = ''
-            return str(result)
+            os.killpg(p.pid, signal.SIGKILL)
+
+        except OSError: # the process group is gone
+            pass
+
+    def __interpolate(self, command):
+        """Do variable interpolation on a string using this node's data"""
 
         try:
-            result = re.sub('%\((.+?)\)s', get_attr, re.sub('%\(data\[(.+?)]\)s', get_data, command))
+            parts = compile_command(command)
         except TypeError:
-            result = None
+            return None
+
+        result = []
+        for literal, data_item, attr in parts:
+            if literal is not None:
+                result.append(literal)
+            elif data_item is not None:
+                result.append(str(self.data.get(data_item, '')))
+            else:
+                result.append(str(getattr(self, attr, '')))
 
-        return result
+        return ''.join(result)
 
 
 class DeploymentSlot(EphemeralNode):
@@ -260,60 +514,346 @@ class DeploymentSlot(EphemeralNode):
     def __init__(self, path, data={}, attrs={}):
 
         self.id = zookeeper.path_join(*zookeeper.path_split(path)[-2:])
+        self.queue_node = None
 
         super(DeploymentSlot, self).__init__(path=path, data=data, attrs=attrs)
 
-    def occupy(self, handle):
-        """Occupy a free deployment slot"""
+    @staticmethod
+    def queue_path_for(app_id):
+        """Return the path of the queue of hosts waiting for a slot of an application (used in queue mode)"""
 
-        self.write(handle=handle)
+        return zookeeper.path_join('queues', app_id)
+
+    def occupy(self, handle, cache=None, watcher=None):
+        """Occupy a free deployment slot
+
+        In queue mode, hosts wait in line for one of the application's slots (see __occupy_queue). Otherwise a slot is
+        only taken while the application's free slot count is positive. If the backend supports transactions, the slot
+        is created and the count decremented in one multi-op (checked against the application version), so a full
+        application is never written to.
+        """
+
+        app_path = zookeeper.get_parent_node(self.path)
+        conflicts = 0
+
+        try:
+            while True:
+                try:
+                    app = Application.read(handle=handle, path=app_path, cache=cache)
+
+                    if app.data['slot_mode'] == 'queue':
+                        self.__occupy_queue(handle=handle, app=app, watcher=watcher)
+                    elif zookeeper.supports_multi():
+                        self.__occupy_transaction(handle=handle, app=app, cache=cache)
+                    else:
+                        self.__occupy_sequentially(handle=handle, app=app, cache=cache)
+                    break
+
+                except zookeeper.BadVersionException:
+                    conflicts += 1
+                    cas_backoff('occupy', app_path, conflicts)
+
+        finally:
+            cas_conflicts.record('occupy', app_path, conflicts)
+
+    def __occupy_queue(self, handle, app, watcher):
+        """Join (or keep our place in) the application's queue and occupy a slot once at its front
+
+        Each host waits in line with a sequential ephemeral node, and the hosts with the `slots` lowest sequence
+        numbers hold the slots. The first waiting host watches the queue's children, so whichever holder leaves wakes
+        it up. Hosts further back watch the node just ahead of their own, which is deleted when that host leaves the
+        queue or written to when it takes a slot. Every handoff thus wakes up a single waiter (the watcher is called
+        when it should try again).
+        """
+
+        queue_path = self.queue_path_for(app.id)
+        host_id = zookeeper.path_split(self.path)[-1]
+        session_id = zookeeper.client_id(handle)[0]
+        slots = int(app.data['slots'])
+
+        queue = self.__list_queue(handle, queue_path)
+
+        self.queue_node = None
+        for name in queue:
+            if name.rsplit('-', 1)[0] == host_id:
+                stat = zookeeper.exists(handle, zookeeper.path_join(queue_path, name, relative=True))
+                if stat and stat['ephemeralOwner'] == session_id:
+                    self.queue_node = zookeeper.path_join(queue_path, name, relative=True)
+                    break
+
+        # a host that already had a place in line has been waiting, and hosts behind it may be watching its node
+        waited = self.queue_node is not None
+
+        if self.queue_node is None:
+            self.queue_node = zookeeper.create(handle, zookeeper.path_join(queue_path, host_id + '-', relative=True), '', [zookeeper.ZOO_OPEN_ACL_UNSAFE], zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+            logging.getLogger().debug('Joined the deployment queue of %s as %s', app.id, self.queue_node)
+
+            # hosts that joined between listing the queue and creating our node are ahead of us
+            queue = self.__list_queue(handle, queue_path)
 
         while True:
-            try:
-                app = Application.read(handle=handle, path=zookeeper.get_parent_node(self.path))
+            position = queue.index(zookeeper.path_split(self.queue_node)[-1])
+            if position < slots:
+                break
+
+            if slots <= 0:
+                raise Application.DeploymentSlotOverflow
 
-                if app.deployment_slot_overflow(handle=handle):
-                    delete(handle=handle, path=self.path)
+            waited = True
+            if position == slots:
+                latest = self.__list_queue(handle, queue_path, watcher)
+                if latest[:position] == queue[:position]:
+                    logging.getLogger().debug('Waiting in the deployment queue of %s at position %d (first in line)', app.id, position)
                     raise Application.DeploymentSlotOverflow
-                else:
-                    app.data['slots'] = int(app.data['slots']) - 1
-                    app.write(handle=handle, overwrite_if_version=app.version)
-                    break
 
-            except zookeeper.BadVersionException:
-                logging.getLogger().debug('Version mismatch (retrying)')
+            else:
+                ahead = zookeeper.path_join(queue_path, queue[position - 1], relative=True)
+                stat = zookeeper.exists(handle, ahead, watcher)
+                if stat and not stat['version']:
+                    logging.getLogger().debug('Waiting in the deployment queue of %s at position %d (watching %s)', app.id, position, ahead)
+                    raise Application.DeploymentSlotOverflow
+                latest = self.__list_queue(handle, queue_path)
+
+            # a host ahead of us left the queue or took a slot
+            queue = latest
+
+        if waited:
+            zookeeper.set(handle, self.queue_node, 'occupied')
+
+        self.write(handle=handle)
+
+    @staticmethod
+    def __list_queue(handle, queue_path, watcher=None):
+        """Return the names of the nodes in a deployment queue, in the order in which they joined it"""
+
+        try:
+            queue = zookeeper.get_children(handle, queue_path, watcher)
+        except zookeeper.NoNodeException:
+            try:
+                zookeeper.create_r(handle, queue_path)
+            except zookeeper.NodeExistsException: # another host created the queue first
+                pass
+            queue = zookeeper.get_children(handle, queue_path, watcher)
+
+        return sorted(queue, key=lambda name: name[-10:])
+
+    @classmethod
+    def leave_queue(self, handle, app_id, host_id):
+        """Remove this session's node from an application's queue (when the host no longer needs a slot)"""
+
+        queue_path = self.queue_path_for(app_id)
+        session_id = zookeeper.client_id(handle)[0]
+
+        try:
+            queue = zookeeper.get_children(handle, queue_path)
+        except zookeeper.NoNodeException:
+            return
+
+        for name in queue:
+            if name.rsplit('-', 1)[0] == host_id:
+                queue_node = zookeeper.path_join(queue_path, name, relative=True)
+                stat = zookeeper.exists(handle, queue_node)
+                if stat and stat['ephemeralOwner'] == session_id:
+                    try:
+                        delete(handle=handle, path=queue_node)
+                    except zookeeper.NoNodeException:
+                        pass
+                    logging.getLogger().info('Left the deployment queue of %s', app_id)
+
+    def __occupy_transaction(self, handle, app, cache):
+        """Decrement the free slot count and create the slot node in one transaction"""
+
+        if int(app.data['slots']) <= 0:
+            raise Application.DeploymentSlotOverflow
+
+        app.data['slots'] = int(app.data['slots']) - 1
+
+        try:
+            zookeeper.multi(handle, [
+                zookeeper.set_op(app.path, app.encode(), app.version),
+                zookeeper.create_op(self.path, self.encode(), flags=zookeeper.EPHEMERAL)
+            ])
+
+        except zookeeper.NodeExistsException:
+            # the slot survives a resumed session, in which case it is still ours (and already counted)
+            stat = zookeeper.exists(handle, self.path)
+            if not stat or stat['ephemeralOwner'] != zookeeper.client_id(handle)[0]:
+                raise Application.DeploymentSlotOverflow
+            logging.getLogger().info('Deployment slot %s is already occupied by this session', self.path)
+
+        finally:
+            if cache:
+                cache.invalidate(app.path)
+                cache.invalidate(self.path)
+
+    def __occupy_sequentially(self, handle, app, cache):
+        """Create the slot node, then decrement the free slot count (checked against the application version)"""
+
+        if int(app.data['slots']) <= 0:
+            raise Application.DeploymentSlotOverflow
+
+        try:
+            self.write(handle=handle, overwrite=False, cache=cache)
+        except zookeeper.NodeExistsException:
+            # the slot survives a resumed session, in which case it is still ours (and already counted)
+            stat = zookeeper.exists(handle, self.path)
+            if not stat or stat['ephemeralOwner'] != zookeeper.client_id(handle)[0]:
+                raise Application.DeploymentSlotOverflow
+            logging.getLogger().info('Deployment slot %s is already occupied by this session', self.path)
+            return
+
+        app.data['slots'] = int(app.data['slots']) - 1
+        try:
+            app.write(handle=handle, overwrite_if_version=app.version, cache=cache)
+        except zookeeper.BadVersionException:
+            # another host took or freed a slot in the meantime, so check the count again before trying once more
+            delete(handle=handle, path=self.path, cache=cache)
+            raise
 
     @classmethod
-    def free(self, handle, path, deploy_result):
-        """Free up a deployment slot"""
+    def free(self, handle, path, deploy_result, version=None, cache=None, queue_node=None, publish_id=None):
+        """Free up a deployment slot and record the deployment result (of the given version and publish id)
 
-        delete(handle=handle, path=path)
+        If the backend supports transactions, the slot (and queue) node is deleted, the application's free slot (and
+        failure) count updated and the result recorded in one multi-op. In queue mode, the application is only
+        written to when a failure has to be counted. Returns the version of the application node after the update.
+        """
 
         host_id = zookeeper.path_split(path)[-1]
 
-        while True:
+        if deploy_result == True:
+            result = 'successful'
+        elif deploy_result == False:
+            result = 'failed'
+        else:
+            result = 'skipped'
+
+        app_path = zookeeper.get_parent_node(path)
+        conflicts = 0
+
+        if not zookeeper.supports_multi():
+            delete(handle=handle, path=path, cache=cache)
+
+        try:
+            while True:
+                try:
+                    app = Application.read(handle=handle, path=app_path, cache=cache)
+
+                    if version is None:
+                        version, publish_id = app.data['version'], app.data['publish_id']
+
+                    update_app = app.data['slot_mode'] != 'queue'
+                    if update_app:
+                        app.data['slots'] = int(app.data['slots']) + int(app.data['slot_increment'])
+                    if result == 'failed' and (app.data['version'], app.data['publish_id']) == (version, publish_id):
+                        app.data['failures'] = int(app.data['failures']) + 1
+                        update_app = True
+
+                    deployment_result = DeploymentResult(path=DeploymentResult.path_for(app.id, publish_id or version, host_id), data={'result': result})
+
+                    if zookeeper.supports_multi():
+                        self.__free_transaction(handle=handle, path=path, app=update_app and app or None, deployment_result=deployment_result, queue_node=queue_node, cache=cache)
+                    else:
+                        if update_app:
+                            app.write(handle=handle, overwrite_if_version=app.version, cache=cache)
+                        deployment_result.write(handle=handle)
+                    break
+
+                except zookeeper.BadVersionException:
+                    conflicts += 1
+                    cas_backoff('free', app_path, conflicts)
+
+        finally:
+            cas_conflicts.record('free', app_path, conflicts)
+
+        if queue_node and not zookeeper.supports_multi():
             try:
-                app = Application.read(handle=handle, path=zookeeper.get_parent_node(path))
+                delete(handle=handle, path=queue_node)
+            except zookeeper.NoNodeException:
+                pass
+
+        if result == 'failed':
+            logging.getLogger().error('Deployment of %s %s recorded as: %s', app.id, version, result)
+        else:
+            logging.getLogger().info('Deployment of %s %s recorded as: %s', app.id, version, result)
 
-                if deploy_result == True:
-                    result = 'successful'
-                    logging.getLogger().info('Deployment of %s %s recorded as: %s', app.id, app.data['version'], result)
+        return update_app and app.version + 1 or app.version
 
-                elif deploy_result == False:
-                    result = 'failed'
-                    logging.getLogger().error('Deployment of %s %s recorded as: %s', app.id, app.data['version'], result)
+    @classmethod
+    def __free_transaction(self, handle, path, app, deployment_result, queue_node, cache):
+        """Delete the slot (and queue) node, update the application (if specified) and record the result in one transaction"""
+
+        deletes = [path] + (queue_node and [queue_node] or [])
+        create_result = True
+        parent_exists = False
 
+        try:
+            while True:
+                ops = [zookeeper.delete_op(p) for p in deletes]
+                if app:
+                    ops.append(zookeeper.set_op(app.path, app.encode(), app.version))
+                if create_result:
+                    ops.append(zookeeper.create_op(deployment_result.path, deployment_result.encode()))
                 else:
-                    result = 'skipped'
-                    logging.getLogger().info('Deployment of %s %s recorded as: %s', app.id, app.data['version'], result)
+                    ops.append(zookeeper.set_op(deployment_result.path, deployment_result.encode()))
 
-                if host_id not in app.data[result]:
-                    app.data[result].extend([host_id])
+                try:
+                    zookeeper.multi(handle, ops)
+                    break
 
-                app.data['slots'] = int(app.data['slots']) + int(app.data['slot_increment'])
+                except zookeeper.NoNodeException:
+                    # the first result of a version needs its parent node
+                    if create_result and not parent_exists:
+                        try:
+                            zookeeper.create_r(handle, zookeeper.get_parent_node(deployment_result.path))
+                        except zookeeper.NodeExistsException: # another host recorded a result first
+                            pass
+                        parent_exists = True
+                        continue
 
-                app.write(handle=handle, overwrite_if_version=app.version)
-                break
+                    # the slot (or queue) node went away with an expired session, but it was never given back
+                    missing = [p for p in deletes if not zookeeper.exists(handle, p)]
+                    if not missing:
+                        raise
+                    for p in missing:
+                        logging.getLogger().warn('Deployment slot %s no longer exists', p)
+                        deletes.remove(p)
+
+                except zookeeper.NodeExistsException:
+                    create_result = False
+
+        finally:
+            if cache:
+                cache.invalidate(zookeeper.get_parent_node(path))
+                cache.invalidate(path)
+
+
+class DeploymentResult(PersistentNode):
+    """Deployment result node class (one per application, version and host)"""
+
+    DEFAULTS = {
+        'result': None
+    }
+
+    def __init__(self, path, data={}, attrs={}):
+
+        self.id = zookeeper.path_split(path)[-1]
+
+        data = self.with_defaults(data)
+
+        super(DeploymentResult, self).__init__(path=path, data=data, attrs=attrs)
+
+    @staticmethod
+    def quote(version):
+        """Return a version string that is safe to use as a node name"""
+
+        return urllib.quote(str(version), safe='')
+
+    @classmethod
+    def path_for(self, app_id, key=None, host_id=None):
+        """Return the path of a result node (or of its parents if key/host_id are omitted, see Application.results_key)"""
+
+        if key is not None:
+            key = self.quote(key)
 
-            except zookeeper.BadVersionException:
-                logging.getLogger().debug('Version mismatch (retrying)')
+        return zookeeper.path_join('results', app_id, key, host_id)
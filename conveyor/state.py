@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+STATE_FILE = 'deployments.db'
+STATE_TTL = 3600
+
+
+def fingerprint(application):
+    """Return a fingerprint of the commands used to probe and deploy an application"""
+
+    commands = [application.id, application.get_version_command(), application.deploy_command()]
+    return hashlib.sha1(json.dumps(commands)).hexdigest()
+
+
+class StateStore(object):
+    """Persistent record of the application versions installed on this host"""
+
+    def __init__(self, path, ttl=STATE_TTL):
+        """Open (or create) the store (path may be a directory, and a ttl of 0 or None trusts recorded versions forever)"""
+
+        if os.path.isdir(path):
+            path = os.path.join(path, STATE_FILE)
+
+        self.path = path
+        self.ttl = float(ttl or 0)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS deployments (id TEXT PRIMARY KEY, version TEXT, fingerprint TEXT, recorded REAL)')
+        self.db.commit()
+
+        logging.getLogger().info('Using deployment state store: %s', path)
+
+    def lookup(self, app_id, fingerprint):
+        """Return the installed version of an application (or None if unknown, stale or recorded with other commands)"""
+
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT version, fingerprint, recorded FROM deployments WHERE id = ?', (app_id,)).fetchone()
+        finally:
+            self.lock.release()
+
+        if row is None:
+            return None
+
+        version, recorded_fingerprint, recorded = row
+        if recorded_fingerprint != fingerprint or (self.ttl and time.time() - recorded > self.ttl):
+            logging.getLogger().debug('Recorded version of %s is stale', app_id)
+            return None
+
+        return version
+
+    def record(self, app_id, version, fingerprint):
+        """Record the installed version of an application"""
+
+        self.lock.acquire()
+        try:
+            self.db.execute('INSERT OR REPLACE INTO deployments (id, version, fingerprint, recorded) VALUES (?, ?, ?, ?)', (app_id, version, fingerprint, time.time()))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def invalidate(self, app_id):
+        """Forget the installed version of an application"""
+
+        self.lock.acquire()
+        try:
+            self.db.execute('DELETE FROM deployments WHERE id = ?', (app_id,))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Close the store"""
+
+        self.lock.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.lock.release()
@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from . import codec
+from . import nodes
+from . import zookeeper
+
+
+STATUS_TIMEOUT = 10
+
+
+class Reads(object):
+    """Asynchronous reads that are sent together (pipelined) and collected as their completions arrive"""
+
+    def __init__(self, handle):
+        """Create an empty set of reads on a session"""
+
+        self.handle = handle
+        self.cv = threading.Condition()
+        self.outstanding = 0
+        self.results = {}
+        self.errors = {}
+
+    def get(self, key, path):
+        """Start reading a node (its (data, stat) tuple is stored under key)"""
+
+        self.__start(zookeeper.aget, key, path)
+
+    def get_children(self, key, path):
+        """Start listing the children of a node (stored under key)"""
+
+        self.__start(zookeeper.aget_children, key, path)
+
+    def wait(self, timeout=STATUS_TIMEOUT):
+        """Wait for all outstanding reads (raises OperationTimeoutException if they take more than timeout seconds)"""
+
+        deadline = time.time() + timeout
+        self.cv.acquire()
+        try:
+            while self.outstanding:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise zookeeper.OperationTimeoutException('%d read(s) still outstanding' % self.outstanding)
+                self.cv.wait(remaining)
+        finally:
+            self.cv.release()
+
+    def __start(self, function, key, path):
+        """Send a read (a read that cannot be sent is recorded as failed)"""
+
+        self.cv.acquire()
+        try:
+            self.outstanding += 1
+        finally:
+            self.cv.release()
+
+        try:
+            function(self.handle, path, lambda handle, error, result: self.__complete(key, error, result))
+        except zookeeper.ZooKeeperException, e:
+            self.__complete(key, e, None)
+
+    def __complete(self, key, error, result):
+        """Store the outcome of a read (called on the event thread)"""
+
+        self.cv.acquire()
+        try:
+            if error is None:
+                self.results[key] = result
+            else:
+                self.errors[key] = error
+            self.outstanding -= 1
+            if not self.outstanding:
+                self.cv.notifyAll()
+        finally:
+            self.cv.release()
+
+
+def decode(value, path):
+    """Return the decoded data of a node (or None if it cannot be decoded)"""
+
+    try:
+        return codec.decode(value)
+    except codec.DecodeError, e:
+        logging.getLogger().error('Unable to decode data of %s (%s): %r', path, e, value)
+        return None
+
+
+def rollout(handle, app_id, timeout=STATUS_TIMEOUT):
+    """Return how far the current version of an application has been deployed across the registered hosts
+
+    The application, its slots, deployment queue, hosts and results are read with pipelined asynchronous calls in
+    three rounds (the result and host nodes depend on the listings of the previous rounds), so the time taken hardly
+    grows with the number of hosts.
+    """
+
+    app_path = zookeeper.path_join('applications', app_id)
+    hosts_path = zookeeper.path_join('hosts')
+
+    reads = Reads(handle)
+    reads.get('application', app_path)
+    reads.get_children('slots', app_path)
+    reads.get_children('queue', nodes.DeploymentSlot.queue_path_for(app_id))
+    reads.get_children('hosts', hosts_path)
+    reads.wait(timeout)
+
+    if 'application' in reads.errors:
+        raise reads.errors['application']
+    data, stat = reads.results['application']
+    app = nodes.Application(path=app_path, data=decode(data, app_path) or {}, attrs=stat)
+
+    results_path = nodes.DeploymentResult.path_for(app.id, app.results_key())
+    reads.get_children('results', results_path)
+    for host_id in reads.results.get('hosts', []):
+        reads.get(('host', host_id), zookeeper.path_join(hosts_path, host_id, relative=True))
+    reads.wait(timeout)
+
+    for host_id in reads.results.get('results', []):
+        reads.get(('result', host_id), zookeeper.path_join(results_path, host_id, relative=True))
+    reads.wait(timeout)
+
+    targeted = set()
+    for host_id in reads.results.get('hosts', []):
+        if ('host', host_id) in reads.results:
+            data = decode(reads.results[('host', host_id)][0], host_id)
+            if isinstance(data, dict) and set(data.get('groups', [])) & set(app.data['groups']):
+                targeted.add(host_id)
+
+    results = {}
+    for host_id in reads.results.get('results', []):
+        if ('result', host_id) in reads.results:
+            data = decode(reads.results[('result', host_id)][0], host_id)
+            results[host_id] = isinstance(data, dict) and data.get('result') or None
+
+    in_flight = set(reads.results.get('slots', []))
+    queued = set([name.rsplit('-', 1)[0] for name in reads.results.get('queue', [])]) - in_flight
+
+    return {
+        'application': app.id,
+        'version': app.data['version'],
+        'slots': app.data['slots'],
+        'failures': app.data['failures'],
+        'failed_max': app.data['failed_max'],
+        'hosts': len(targeted),
+        'successful': len([r for r in results.values() if r == 'successful']),
+        'failed': len([r for r in results.values() if r == 'failed']),
+        'skipped': len([r for r in results.values() if r == 'skipped']),
+        'pending': len(targeted - set(results) - in_flight - queued),
+        'in_flight': sorted(in_flight),
+        'queued': sorted(queued),
+        'failed_hosts': sorted([host_id for host_id, r in results.items() if r == 'failed'])
+    }
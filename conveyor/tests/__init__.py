@@ -0,0 +1,14 @@
+from __future__ import absolute_import
+
+import threading
+
+
+def wait_for(condition, timeout=5):
+    """Poll a condition until it is true (returns its last value once timeout seconds have passed)"""
+
+    event = threading.Event()
+    for i in range(100):
+        if condition():
+            return True
+        event.wait(timeout / 100.0)
+    return condition()
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+
+import conveyor
+import conveyor.accounting
+from conveyor.tests import wait_for
+
+
+client = None
+daemon = None
+operations = None
+
+
+def setup():
+    global client, daemon, operations
+
+    conveyor.zookeeper.set_backend('memory')
+    operations = conveyor.accounting.install()
+
+    client = conveyor.Conveyor()
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_group'])
+
+
+def deploy(version):
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app'), data={'version': version, 'groups': ['test_group'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    app.write(client.handle)
+    assert wait_for(lambda: app.deployed(handle=client.handle, host_id='test_host'))
+    assert daemon.executor.join(timeout=5)
+
+
+def test_records_operations():
+    operations.reset()
+    conveyor.nodes.PersistentNode(path='/accounting', data={'a': 1}).write(handle=client.handle)
+    conveyor.nodes.PersistentNode.read(handle=client.handle, path='/accounting')
+    conveyor.nodes.delete(handle=client.handle, path='/accounting')
+
+    assert [o.name for o in operations.select(handle=client.handle)] == ['create', 'get', 'delete']
+    summary = operations.summary(handle=client.handle)
+    assert summary[('create', '/accounting')]['bytes_written'] == summary[('get', '/accounting')]['bytes_read'] > 0
+
+
+def test_version_bump_budget():
+    """One version bump of one application on one host (with transactions)"""
+
+    operations.backend.supports_multi = True
+    try:
+        deploy('1.0')
+        operations.reset()
+        deploy('2.0')
+    finally:
+        del operations.backend.supports_multi
+
+    assert operations.reads(handle=daemon.handle) <= 4, operations.select(handle=daemon.handle)
+    assert operations.writes(handle=daemon.handle) <= 4, operations.select(handle=daemon.handle)
+    assert operations.reads(handle=daemon.handle, prefix='/hosts') == 0
+
+
+def test_version_bump_budget_without_multi():
+    """One version bump on a backend without transactions (as with the ZooKeeper C binding)"""
+
+    deploy('1.1')
+    operations.reset()
+    deploy('2.1')
+
+    assert operations.reads(handle=daemon.handle) <= 4, operations.select(handle=daemon.handle)
+    assert operations.writes(handle=daemon.handle) <= 9, operations.select(handle=daemon.handle)
+    assert operations.select('multi', handle=daemon.handle) == []
+
+
+def teardown():
+    daemon.close()
+    client.close()
+    conveyor.accounting.uninstall()
+
+
+def test_reconnect_keeps_session_state():
+    deploy('3.0')
+    operations.reset()
+
+    backend = conveyor.zookeeper.get_backend()
+    backend.disconnect(daemon.handle)
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app'), data={'version': '4.0', 'groups': ['test_group'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    app.write(client.handle)
+    backend.reconnect(daemon.handle)
+
+    assert wait_for(lambda: app.deployed(handle=client.handle, host_id='test_host'))
+    assert daemon.executor.join(timeout=5)
+    assert operations.select(handle=daemon.handle, prefix='/hosts') == []
+    assert operations.select('get_children', handle=daemon.handle) == []
+
+
+def test_new_session_only_checks_unchanged_applications():
+    deploy('5.0')
+    assert wait_for(lambda: daemon.executor.depth() == (0, 0))
+    operations.reset()
+
+    backoff = conveyor.RECONNECT_BACKOFF
+    conveyor.RECONNECT_BACKOFF = 0.01
+    try:
+        handle = daemon.handle
+        conveyor.zookeeper.get_backend().expire(handle)
+        assert wait_for(lambda: daemon.handle != handle and daemon.conn_state == conveyor.zookeeper.CONNECTED_STATE)
+        assert wait_for(lambda: operations.select('exists', handle=daemon.handle, prefix='/applications') != [])
+        assert daemon.executor.join(timeout=5)
+    finally:
+        conveyor.RECONNECT_BACKOFF = backoff
+
+    assert operations.select('get', handle=daemon.handle) == [], operations.select(handle=daemon.handle)
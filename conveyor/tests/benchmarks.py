@@ -0,0 +1,144 @@
+"""Micro-benchmarks for the node and path hot paths
+
+Run with: python -m conveyor.tests.benchmarks [--apps N] [--hosts N] [--results N] [--repeat N]
+
+Everything runs against the in-memory backend, so the numbers measure conveyor's own overhead (serialization, path
+handling, bookkeeping) rather than network latency. Each benchmark reports the best of --repeat runs, which is the most
+stable figure from run to run.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import optparse
+import random
+import sys
+import time
+
+import conveyor
+
+
+def measure(function, number, repeat):
+    """Return the best time per call (in microseconds) of repeat runs of number calls"""
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            function(j)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1000000
+
+
+class Benchmarks(object):
+    """A set of benchmarks sharing one in-memory tree"""
+
+    def __init__(self, apps, hosts, results, repeat, seed=0):
+        """Populate the tree"""
+
+        random.seed(seed)
+        self.apps = apps
+        self.hosts = hosts
+        self.results = results
+        self.repeat = repeat
+
+        conveyor.zookeeper.set_backend('memory')
+        self.client = conveyor.Conveyor()
+        self.handle = self.client.handle
+        self.cache = conveyor.cache.NodeCache()
+
+        self.app_paths = [conveyor.zookeeper.path_join('applications', 'app%d' % i) for i in range(apps)]
+        for path in self.app_paths:
+            conveyor.nodes.Application(path=path, data={
+                'version': '1.0',
+                'groups': ['group%d' % random.randint(0, 29)],
+                'slots': hosts,
+                'get_version_cmd': "/usr/bin/dpkg-query --showformat '${Version}' --show %(id)s",
+                'deploy_cmd': '/usr/bin/aptitude install %(id)s=%(data[version])s'
+            }).write(handle=self.handle)
+
+        self.app = conveyor.nodes.Application.read(handle=self.handle, path=self.app_paths[0])
+        for i in range(results):
+            conveyor.nodes.DeploymentResult(path=conveyor.nodes.DeploymentResult.path_for(self.app.id, '1.0', 'host%d' % i), data={'result': 'successful'}).write(handle=self.handle)
+
+    def run(self):
+        """Run all benchmarks and return a list of (name, calls, microseconds per call) tuples"""
+
+        results = []
+        for name in sorted(dir(self)):
+            if name.startswith('bench_'):
+                number, function = getattr(self, name)()
+                results.append((name[6:], number, measure(function, number, self.repeat)))
+        return results
+
+    def close(self):
+        """Close the session"""
+
+        self.client.close()
+
+    def bench_path_join(self):
+        return 10000, lambda i: conveyor.zookeeper.path_join('applications', 'app', 'host')
+
+    def bench_path_split(self):
+        return 10000, lambda i: conveyor.zookeeper.path_split('/applications/app/host')
+
+    def bench_read_options(self):
+        sources = [[('slots', '1'), ('slot-increment', '1'), ('groups', 'a, b, c')], {'name': 'app', 'version': '1.0', 'deploy-cmd': None}]
+        return 10000, lambda i: conveyor.util.read_options(*sources, to_list=['groups'])
+
+    def bench_interpolate(self):
+        command = self.app.data['deploy_cmd']
+        return 10000, lambda i: self.app._Application__interpolate(command)
+
+    def bench_node_read(self):
+        paths = self.app_paths
+        return 2000, lambda i: conveyor.nodes.Application.read(handle=self.handle, path=paths[i % len(paths)])
+
+    def bench_node_read_cached(self):
+        paths = self.app_paths
+        return 2000, lambda i: conveyor.nodes.Application.read(handle=self.handle, path=paths[i % len(paths)], cache=self.cache)
+
+    def bench_node_write(self):
+        apps = [conveyor.nodes.Application.read(handle=self.handle, path=path) for path in self.app_paths]
+        return 2000, lambda i: apps[i % len(apps)].write(handle=self.handle)
+
+    def bench_deployed(self):
+        hosts = ['host%d' % (i * 2) for i in range(max(1, self.results))]
+        return 2000, lambda i: self.app.deployed(handle=self.handle, host_id=hosts[i % len(hosts)])
+
+    def bench_occupy_and_free(self):
+        slots = [conveyor.zookeeper.path_join('applications', self.app.id, 'host%d' % i) for i in range(self.hosts)]
+
+        def occupy_and_free(i):
+            path = slots[i % len(slots)]
+            conveyor.nodes.DeploymentSlot(path=path).occupy(handle=self.handle, cache=self.cache)
+            conveyor.nodes.DeploymentSlot.free(handle=self.handle, path=path, deploy_result=True, version='1.0', cache=self.cache)
+
+        return 500, occupy_and_free
+
+
+def main(argv=None):
+    """Parse options, run the benchmarks and print the results"""
+
+    op = optparse.OptionParser(description='Micro-benchmarks for the node and path hot paths')
+    op.add_option('--apps', dest='apps', type='int', default=100, help="number of applications (default: %default)")
+    op.add_option('--hosts', dest='hosts', type='int', default=100, help="number of hosts (default: %default)")
+    op.add_option('--results', dest='results', type='int', default=1000, help="number of recorded results (default: %default)")
+    op.add_option('--repeat', dest='repeat', type='int', default=5, help="runs per benchmark (default: %default)")
+    (options, args) = op.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    benchmarks = Benchmarks(apps=options.apps, hosts=options.hosts, results=options.results, repeat=options.repeat)
+    try:
+        print 'apps=%d hosts=%d results=%d repeat=%d' % (options.apps, options.hosts, options.results, options.repeat)
+        for name, number, usec in benchmarks.run():
+            print '%-24s %8d calls %12.2f usec/call' % (name, number, usec)
+    finally:
+        benchmarks.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
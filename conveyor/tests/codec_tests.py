@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+import json
+
+import conveyor
+
+
+def test_encode_leaves_out_defaults():
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'codec_app'), data={'version': '1.0', 'groups': ['a']})
+
+    assert json.loads(app.encode()) == {'version': '1.0', 'groups': ['a']}
+    assert ' ' not in app.encode()
+
+
+def test_decode_plain_json():
+    data = {'version': '1.0', 'groups': ['a'], 'slots': 1, 'slot_increment': 1, 'failed_max': 0, 'failures': 0}
+
+    assert conveyor.codec.decode(json.dumps(data)) == data
+
+
+def test_compressed_round_trip():
+    data = {'version': '1.0', 'deploy_cmd': 'x' * 1000}
+    value = conveyor.codec.encode(data, compress_min=100)
+
+    assert value.startswith(conveyor.codec.MAGIC)
+    assert len(value) < 100
+    assert conveyor.codec.decode(value) == data
+    assert not conveyor.codec.encode(data, compress_min=2000).startswith(conveyor.codec.MAGIC)
+
+
+def test_decode_errors():
+    for value in ('', 'not json', conveyor.codec.MAGIC + conveyor.codec.FORMAT_ZLIB + 'garbage', conveyor.codec.MAGIC + '\x7f', None):
+        try:
+            conveyor.codec.decode(value)
+        except conveyor.codec.DecodeError:
+            pass
+        else:
+            assert False, value
+
+
+def test_read_fills_in_defaults():
+    conveyor.zookeeper.set_backend('memory')
+    client = conveyor.Conveyor()
+    try:
+        app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'codec_app'), data={'version': '2.0', 'deploy_cmd': '/bin/true ' * 200})
+        compress_min = conveyor.codec.COMPRESS_MIN
+        conveyor.codec.COMPRESS_MIN = 100
+        try:
+            app.write(handle=client.handle)
+        finally:
+            conveyor.codec.COMPRESS_MIN = compress_min
+
+        assert conveyor.zookeeper.get(client.handle, app.path)[0].startswith(conveyor.codec.MAGIC)
+        assert conveyor.nodes.Application.read(handle=client.handle, path=app.path).data == app.data
+
+        conveyor.zookeeper.set(client.handle, app.path, 'not json')
+        assert conveyor.nodes.Node.read(handle=client.handle, path=app.path).data is None
+    finally:
+        conveyor.nodes.delete(handle=client.handle, path=app.path)
+        client.close()
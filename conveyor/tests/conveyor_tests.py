@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 
+import os
+import tempfile
+import threading
+
 import conveyor
+from conveyor.tests import wait_for
 
 
 client = None
@@ -10,6 +15,7 @@ apps = []
 def setup():
     global client, apps
 
+    conveyor.zookeeper.set_backend('memory')
     client = conveyor.Conveyor(groups=['test_group0'])
 
     try:
@@ -36,10 +42,465 @@ def test_deployment_slots():
     conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join('applications', 'test_app0', 'test_client')).occupy(handle=client.handle)
     conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=conveyor.zookeeper.path_join('applications', 'test_app0', 'test_client'), deploy_result=True)
 
+    app = conveyor.nodes.Application.read(handle=client.handle, path=conveyor.zookeeper.path_join('applications', 'test_app0'))
+    assert app.deployed(handle=client.handle, host_id='test_client')
+    assert not app.deployed(handle=client.handle, host_id='test_client1')
+
+
+def check_deployment_slot_overflow():
+    app_path = conveyor.zookeeper.path_join('applications', 'test_app1')
+    slot0 = conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app_path, 'test_client0', relative=True))
+    slot1 = conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app_path, 'test_client1', relative=True))
+
+    slot0.occupy(handle=client.handle)
+    try:
+        slot1.occupy(handle=client.handle)
+        assert False
+    except conveyor.nodes.Application.DeploymentSlotOverflow:
+        pass
+    assert conveyor.zookeeper.get_children(client.handle, app_path) == ['test_client0']
+
+    conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slot0.path, deploy_result=False)
+    slot1.occupy(handle=client.handle)
+    conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slot1.path, deploy_result=True)
+
+    app = conveyor.nodes.Application.read(handle=client.handle, path=app_path)
+    assert (app.data['slots'], app.data['failures']) == (1, 1)
+    assert conveyor.zookeeper.get_children(client.handle, app_path) == []
+
+    app.data['failures'] = 0
+    app.write(handle=client.handle)
+    app.delete_results(handle=client.handle)
+
+
+def check_deployment_slots_shared(name):
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', name), data={'version': '1.0', 'slots': 2}).write(client.handle)
+    apps.append(app)
+    slots = [conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app.path, 'test_client%d' % i, relative=True)) for i in range(3)]
+
+    def occupy(slot):
+        try:
+            slot.occupy(handle=client.handle)
+            return True
+        except conveyor.nodes.Application.DeploymentSlotOverflow:
+            return False
+
+    assert [occupy(slot) for slot in slots] == [True, True, False]
+    assert sorted(conveyor.zookeeper.get_children(client.handle, app.path)) == ['test_client0', 'test_client1']
+
+    conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slots[1].path, deploy_result=True)
+    assert occupy(slots[2])
+    assert conveyor.nodes.Application.read(handle=client.handle, path=app.path).data['slots'] == 0
+
+    for slot in (slots[0], slots[2]):
+        conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slot.path, deploy_result=True)
+
+
+def test_deployment_slot_overflow():
+    backend = conveyor.zookeeper.get_backend()
+    for supports_multi in (True, False):
+        backend.supports_multi = supports_multi
+        try:
+            check_deployment_slot_overflow()
+            check_deployment_slots_shared('test_slots%d' % supports_multi)
+        finally:
+            del backend.supports_multi
+
+
+def check_concurrent_first_results(name):
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', name), data={'version': '1.0', 'slots': 2}).write(client.handle)
+    apps.append(app)
+    slots = [conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app.path, 'test_client%d' % i, relative=True)) for i in range(2)]
+    for slot in slots:
+        slot.occupy(handle=client.handle)
+
+    # the other host records the first result of the version between our first attempt and creating its parent
+    create_r = conveyor.zookeeper.create_r
+    def racing_create_r(*args, **kwargs):
+        conveyor.zookeeper.create_r = create_r
+        conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slots[1].path, deploy_result=True)
+        return create_r(*args, **kwargs)
+
+    conveyor.zookeeper.create_r = racing_create_r
+    try:
+        conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slots[0].path, deploy_result=True)
+    finally:
+        conveyor.zookeeper.create_r = create_r
+
+    assert conveyor.nodes.Application.read(handle=client.handle, path=app.path).data['slots'] == 2
+    assert conveyor.zookeeper.get_children(client.handle, app.path) == []
+    assert [app.deployed(handle=client.handle, host_id='test_client%d' % i) for i in range(2)] == [True, True]
+
+
+def test_concurrent_first_results():
+    backend = conveyor.zookeeper.get_backend()
+    for supports_multi in (True, False):
+        backend.supports_multi = supports_multi
+        try:
+            check_concurrent_first_results('test_first_results%d' % supports_multi)
+        finally:
+            del backend.supports_multi
+
+
+def test_occupy_keeps_own_slot():
+    app_path = conveyor.zookeeper.path_join('applications', 'test_app1')
+    slot = conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app_path, 'test_client', relative=True))
+
+    backend = conveyor.zookeeper.get_backend()
+    for supports_multi in (True, False):
+        backend.supports_multi = supports_multi
+        try:
+            # as left behind by a resumed session
+            slot.write(handle=client.handle)
+            slot.occupy(handle=client.handle)
+            assert conveyor.nodes.Application.read(handle=client.handle, path=app_path).data['slots'] == 1
+        finally:
+            del backend.supports_multi
+            conveyor.nodes.delete(handle=client.handle, path=slot.path)
+
+
+def queue_hosts(app_id, slots, hosts):
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', app_id), data={'version': '1.0', 'slot_mode': 'queue', 'slots': slots}).write(client.handle)
+    apps.append(app)
+    app = conveyor.nodes.Application.read(handle=client.handle, path=app.path)
+
+    events = [[] for i in range(hosts)]
+    slots = [conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app.path, 'test_client%d' % i, relative=True)) for i in range(hosts)]
+
+    def occupy(i):
+        try:
+            slots[i].occupy(handle=client.handle, watcher=lambda handle, type, state, path: events[i].append((type, path)))
+            return True
+        except conveyor.nodes.Application.DeploymentSlotOverflow:
+            return False
+
+    def free(i):
+        conveyor.nodes.DeploymentSlot.free(handle=client.handle, path=slots[i].path, deploy_result=True, queue_node=slots[i].queue_node)
+
+    return app, events, occupy, free
+
+
+def test_deployment_queue():
+    app, events, occupy, free = queue_hosts('test_queue', 1, 3)
+    assert [occupy(i) for i in range(3)] == [True, False, False]
+
+    # every handoff wakes up the next host in line only
+    free(0)
+    assert wait_for(lambda: events[1])
+    assert not events[2]
+    assert occupy(1)
+
+    # taking the slot moves the host behind up to the front of the line
+    assert wait_for(lambda: events[2])
+    assert not occupy(2)
+    free(1)
+    assert wait_for(lambda: len(events[2]) == 2)
+    assert occupy(2)
+
+    free(2)
+    assert conveyor.nodes.Application.read(handle=client.handle, path=app.path).version == app.version
+    assert [app.deployed(handle=client.handle, host_id='test_client%d' % i) for i in range(3)] == [True] * 3
+    assert conveyor.zookeeper.get_children(client.handle, conveyor.nodes.DeploymentSlot.queue_path_for(app.id)) == []
+
+
+def test_deployment_queue_releases_out_of_order():
+    app, events, occupy, free = queue_hosts('test_queue2', 2, 4)
+    assert [occupy(i) for i in range(4)] == [True, True, False, False]
+
+    # the second holder finishing first hands its slot to the first host in line
+    free(1)
+    assert wait_for(lambda: events[2])
+    assert occupy(2)
+    assert wait_for(lambda: events[3])
+    assert not occupy(3)
+
+    free(0)
+    assert wait_for(lambda: len(events[3]) == 2)
+    assert occupy(3)
+
+    for i in (2, 3):
+        free(i)
+    assert conveyor.zookeeper.get_children(client.handle, conveyor.nodes.DeploymentSlot.queue_path_for(app.id)) == []
+
+
+def test_leave_deployment_queue():
+    app, events, occupy, free = queue_hosts('test_queue3', 1, 2)
+    assert [occupy(i) for i in range(2)] == [True, False]
+
+    conveyor.nodes.DeploymentSlot.leave_queue(handle=client.handle, app_id=app.id, host_id='test_client1')
+    assert len(conveyor.zookeeper.get_children(client.handle, conveyor.nodes.DeploymentSlot.queue_path_for(app.id))) == 1
+
+    free(0)
+    assert conveyor.zookeeper.get_children(client.handle, conveyor.nodes.DeploymentSlot.queue_path_for(app.id)) == []
+
+
+def test_run_command_keeps_bounded_tail():
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app0'))
+    result = app.run_command('seq 1 %d' % (conveyor.nodes.COMMAND_OUTPUT_LINES * 10))
+    assert result.splitlines() == [str(i) for i in range(conveyor.nodes.COMMAND_OUTPUT_LINES * 9 + 1, conveyor.nodes.COMMAND_OUTPUT_LINES * 10 + 1)]
+
+
+
+def test_run_command_interpolation():
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app0'), data={'version': '1.0 beta', 'deploy_cmd': 'echo %(id)s=%(data[version])s %(missing)s%(data[missing])s.'})
+
+    assert app.run_command(app.deploy_command()) == 'test_app0=1.0 beta .'
+    assert app.run_command(['printf', '[%s]', '%(id)s', '%(data[version])s', '$HOME;']) == '[test_app0][1.0 beta][$HOME;]'
+    assert conveyor.nodes.compile_command('a %(id)s b') is conveyor.nodes.compile_command('a %(id)s b')
+
+    try:
+        app.run_command(None)
+    except conveyor.nodes.Application.CommandError:
+        pass
+    else:
+        assert False
+
+
+def test_executor_debounces_delayed_submissions():
+    handled = []
+    executor = conveyor.DeploymentExecutor(handler=handled.append, workers=2)
+    try:
+        for i in range(3):
+            executor.submit('/applications/a', delay=0.3)
+            executor.submit('/applications/b', delay=0.3)
+            threading.Event().wait(0.1)
+        executor.submit('/applications/b')
+        assert wait_for(lambda: handled == ['/applications/b'], timeout=0.2)
+
+        assert executor.join(timeout=5)
+        assert handled == ['/applications/b', '/applications/a']
+
+        # a delayed submission doesn't hold back an immediate one that is still queued
+        executor.cv.acquire()
+        try:
+            executor.submit('/applications/c')
+            executor.submit('/applications/c', delay=1)
+        finally:
+            executor.cv.release()
+        assert wait_for(lambda: '/applications/c' in handled, timeout=0.2)
+    finally:
+        executor.stop()
+
+
+def test_daemon_deploys_application():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_group0'])
+
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app3'), data={'version': '1.0', 'groups': ['test_group0'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    app.write(client.handle)
+    apps.append(app)
+
+    assert wait_for(lambda: conveyor.nodes.Application.read(handle=client.handle, path=app.path).deployed(handle=client.handle, host_id='test_host'))
+    assert 'conveyor_deploy_seconds_count{application="test_app3",result="successful"} 1' in daemon.metrics.render().splitlines()
+    daemon.close()
+
+
+def test_daemon_fails_deployments_that_time_out():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_group0'])
+
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_app4'), data={'version': '1.0', 'groups': ['test_group0'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/sleep 30', 'deploy_timeout': 0.2})
+    app.write(client.handle)
+    apps.append(app)
+
+    result_path = conveyor.nodes.DeploymentResult.path_for(app.id, '1.0', 'test_host')
+    assert wait_for(lambda: conveyor.zookeeper.exists(client.handle, result_path))
+    assert conveyor.nodes.DeploymentResult.read(handle=client.handle, path=result_path).data['result'] == 'failed'
+    assert conveyor.nodes.list_children(handle=client.handle, path=app.path) == []
+    assert conveyor.nodes.Application.read(handle=client.handle, path=app.path).data['slots'] == 1
+    daemon.close()
+
+
+def test_daemon_batches_deployments():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_batch'], batch_linger=0.5)
+
+    # timeouts from hoist.conf are strings
+    timeouts = []
+    run_batch_command = conveyor.nodes.Application.__dict__['run_batch_command']
+    def recording_run_batch_command(cls, applications, output=None, timeout=None):
+        timeouts.append(timeout)
+        return run_batch_command.__get__(None, cls)(applications, output=output, timeout=timeout)
+
+    fd, log = tempfile.mkstemp()
+    os.close(fd)
+    conveyor.nodes.Application.run_batch_command = classmethod(recording_run_batch_command)
+    try:
+        batch = []
+        for i in range(3):
+            batch.append(conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_batch%d' % i), data={'version': '1.%d' % i, 'groups': ['test_batch'], 'get_version_cmd': '/bin/echo 0', 'batch_deploy_cmd': '/bin/echo %(items)s >> ' + log, 'deploy_timeout': ['9', '10', 2.5][i]}))
+        for app in batch:
+            app.write(client.handle)
+            apps.append(app)
+
+        assert wait_for(lambda: [app.deployed(handle=client.handle, host_id='test_host') for app in batch] == [True] * 3)
+        assert [sorted(line.split()) for line in open(log)] == [['test_batch0=1.0', 'test_batch1=1.1', 'test_batch2=1.2']]
+        assert timeouts == [10.0]
+    finally:
+        conveyor.nodes.Application.run_batch_command = run_batch_command
+        os.unlink(log)
+        daemon.close()
+
+
+def test_daemon_deploys_one_by_one_when_batch_fails():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_batch'], batch_linger=0.5)
+
+    batch = []
+    for i, deploy_cmd in enumerate(['/bin/true', None]):
+        batch.append(conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_batch%d' % i), data={'version': '2.0', 'groups': ['test_batch'], 'get_version_cmd': '/bin/echo 0', 'batch_deploy_cmd': '/bin/false', 'deploy_cmd': deploy_cmd}))
+    for app in batch:
+        app.write(client.handle)
+
+    result_paths = [conveyor.nodes.DeploymentResult.path_for(app.id, '2.0', 'test_host') for app in batch]
+    assert wait_for(lambda: [conveyor.zookeeper.exists(client.handle, path) is not None for path in result_paths] == [True, True])
+    assert [conveyor.nodes.DeploymentResult.read(handle=client.handle, path=path).data['result'] for path in result_paths] == ['successful', 'failed']
+    daemon.close()
+
+
+def test_daemon_leaves_queue_of_removed_application():
+    app, events, occupy, free = queue_hosts('test_queue4', 1, 1)
+    app.data.update({'groups': ['test_queue4'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    app.write(client.handle)
+    assert occupy(0)
+
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_queue4'])
+    queue_path = conveyor.nodes.DeploymentSlot.queue_path_for(app.id)
+    assert wait_for(lambda: len(conveyor.zookeeper.get_children(client.handle, queue_path)) == 2)
+
+    # a host that no longer deploys the application gives up its place in line
+    app.data['groups'] = ['test_other']
+    app.write(client.handle)
+    assert wait_for(lambda: len(conveyor.zookeeper.get_children(client.handle, queue_path)) == 1)
+    daemon.close()
+    free(0)
+
+
+def test_daemon_retries_republished_application():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_republish'])
+
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_republish'), data={'version': '1.0', 'groups': ['test_republish'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/false'})
+    conveyor.manifest.apply(handle=client.handle, applications=[app])
+    apps.append(app)
+    first = conveyor.nodes.Application.read(handle=client.handle, path=app.path)
+    failed_path = conveyor.nodes.DeploymentResult.path_for(app.id, first.results_key(), 'test_host')
+    assert wait_for(lambda: conveyor.zookeeper.exists(client.handle, failed_path))
+
+    # publishing the same version again starts over, without deleting the failed result first
+    app.data['deploy_cmd'] = '/bin/true'
+    conveyor.manifest.apply(handle=client.handle, applications=[app])
+    second = conveyor.nodes.Application.read(handle=client.handle, path=app.path)
+    assert second.results_key() != first.results_key()
+    assert wait_for(lambda: second.deployed(handle=client.handle, host_id='test_host'))
+    assert conveyor.nodes.DeploymentResult.read(handle=client.handle, path=conveyor.nodes.DeploymentResult.path_for(app.id, second.results_key(), 'test_host')).data['result'] == 'successful'
+    assert conveyor.zookeeper.exists(client.handle, failed_path)
+    daemon.close()
+
+    # results of earlier publishes are pruned separately
+    assert second.delete_results(handle=client.handle, keep=second.results_key()) == [first.results_key()]
+    assert not conveyor.zookeeper.exists(client.handle, failed_path)
+    assert second.deployed(handle=client.handle, host_id='test_host')
+
+
+def test_daemon_resumes_session():
+    fd, session_file = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        daemon = conveyor.Conveyor(host_id='test_resume', groups=['test_resume'], session_file=session_file)
+        session_id = conveyor.zookeeper.client_id(daemon.handle)[0]
+
+        app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_resume'), data={'version': '1.0', 'groups': ['test_resume'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+        app.write(client.handle)
+        apps.append(app)
+        assert wait_for(lambda: app.path in daemon.seen)
+        daemon.close(keep_session=True)
+        host_mzxid = conveyor.zookeeper.exists(client.handle, '/hosts/test_resume')['mzxid']
+
+        # the restarted daemon keeps the Host node and only watches the unchanged application again
+        read = []
+        get = conveyor.zookeeper.get
+        conveyor.zookeeper.get = lambda handle, path, *args: read.append(path) or get(handle, path, *args)
+        try:
+            daemon = conveyor.Conveyor(host_id='test_resume', groups=['test_resume'], session_file=session_file)
+            assert wait_for(lambda: app.path in daemon.app_watchers)
+            assert daemon.executor.join(timeout=5)
+        finally:
+            conveyor.zookeeper.get = get
+        assert conveyor.zookeeper.client_id(daemon.handle)[0] == session_id
+        assert conveyor.zookeeper.exists(client.handle, '/hosts/test_resume')['ephemeralOwner'] == session_id
+        assert conveyor.zookeeper.exists(client.handle, '/hosts/test_resume')['mzxid'] == host_mzxid
+        assert app.path not in read
+        daemon.close()
+    finally:
+        os.unlink(session_file)
+
+
+def test_daemon_jitters_new_sessions_only():
+    fd, session_file = tempfile.mkstemp()
+    os.close(fd)
+    delays = []
+    backoff = conveyor.util.backoff
+    conveyor.util.backoff = lambda attempt, base, cap: delays.append((attempt, base, cap)) or 0
+    try:
+        daemon = conveyor.Conveyor(session_file=session_file, connect_jitter=3)
+        daemon.close(keep_session=True)
+        assert delays == [(1, 3.0, 3.0)]
+
+        # resuming the saved session doesn't wait
+        daemon = conveyor.Conveyor(session_file=session_file, connect_jitter=3)
+        daemon.close()
+        assert delays == [(1, 3.0, 3.0)]
+    finally:
+        conveyor.util.backoff = backoff
+        os.unlink(session_file)
+
+
+def test_daemon_replaces_expired_session():
+    fd, session_file = tempfile.mkstemp()
+    os.close(fd)
+    backoff = conveyor.RECONNECT_BACKOFF
+    conveyor.RECONNECT_BACKOFF = 0.1
+    try:
+        daemon = conveyor.Conveyor(host_id='test_expire', session_file=session_file)
+        handle = daemon.handle
+        session_id = conveyor.zookeeper.client_id(handle)[0]
+
+        conveyor.zookeeper.get_backend().expire(handle)
+        assert wait_for(lambda: daemon.handle != handle and daemon.conn_state == conveyor.zookeeper.CONNECTED_STATE)
+
+        new_session_id = conveyor.zookeeper.client_id(daemon.handle)[0]
+        assert new_session_id != session_id
+        assert open(session_file).read().split()[0] == '%x' % new_session_id
+        assert wait_for(lambda: conveyor.zookeeper.exists(client.handle, '/hosts/test_expire') is not None)
+        daemon.close()
+    finally:
+        conveyor.RECONNECT_BACKOFF = backoff
+        os.unlink(session_file)
+
+
+def test_daemon_watches_only_its_groups():
+    daemon = conveyor.Conveyor(host_id='test_host', groups=['test_index0'], group_index=True)
+
+    mine = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_index0'), data={'version': '1.0', 'groups': ['test_index0'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    other = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'test_index1'), data={'version': '1.0', 'groups': ['test_index1'], 'get_version_cmd': '/bin/echo 0', 'deploy_cmd': '/bin/true'})
+    for app in (other, mine):
+        app.write(client.handle)
+        conveyor.index.update(handle=client.handle, application=app)
+        apps.append(app)
+
+    assert wait_for(lambda: mine.deployed(handle=client.handle, host_id='test_host'))
+    assert daemon.executor.join(timeout=5)
+    assert other.path not in daemon.app_watchers
+    assert not other.deployed(handle=client.handle, host_id='test_host')
+
+    # moving an application into one of our groups makes it show up
+    other.data['groups'] = ['test_index0', 'test_index1']
+    other.write(client.handle)
+    conveyor.index.update(handle=client.handle, application=other, previous_groups=['test_index1'])
+    assert wait_for(lambda: other.deployed(handle=client.handle, host_id='test_host'))
+    daemon.close()
+
 
 def teardown():
     for app in apps:
         conveyor.nodes.delete(handle=client.handle, path=app.path)
+        app.delete_results(handle=client.handle)
 
     conveyor.nodes.delete(handle=client.handle, path=conveyor.zookeeper.path_join('applications'))
 
@@ -26,4 +26,12 @@ def test_list_applications():
 
 
 def test_delete_applications():
-    run_command('./bin/hoist application delete test')
\ No newline at end of file
+    run_command('./bin/hoist application delete test')
+
+
+def test_batch():
+    lines = 'application create test_batch 1 --groups=group2 --slots=5\n--servers=elsewhere application list\napplication get test_batch\napplication delete test_batch\n'
+    output = subprocess.Popen('./bin/hoist --batch', shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(lines)[0]
+    results = [json.loads(line) for line in output.splitlines()]
+    assert [result['ok'] for result in results] == [True, False, True, True]
+    assert (results[2]['result']['groups'], results[2]['result']['slots']) == (['group2'], 5)
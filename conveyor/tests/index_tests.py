@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+
+import conveyor
+
+
+client = None
+
+
+def setup():
+    global client
+
+    conveyor.zookeeper.set_backend('memory')
+    client = conveyor.Conveyor()
+
+
+def teardown():
+    for name in ('index_a', 'index_b'):
+        path = conveyor.zookeeper.path_join('applications', name)
+        if conveyor.zookeeper.exists(client.handle, path):
+            conveyor.nodes.delete(handle=client.handle, path=path)
+
+    client.close()
+
+
+def application(name, groups):
+    return conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', name), data={'version': '1.0', 'groups': groups})
+
+
+def indexed(group):
+    try:
+        return sorted(conveyor.zookeeper.get_children(client.handle, conveyor.index.path_for(group)))
+    except conveyor.zookeeper.NoNodeException:
+        return []
+
+
+def test_update():
+    app = application('index_a', ['a', 'b']).write(client.handle)
+    conveyor.index.update(handle=client.handle, application=app)
+    assert (indexed('a'), indexed('b')) == (['index_a'], ['index_a'])
+
+    app = application('index_a', ['b', 'c']).write(client.handle)
+    conveyor.index.update(handle=client.handle, application=app, previous_groups=['a', 'b'])
+    assert (indexed('a'), indexed('b'), indexed('c')) == ([], ['index_a'], ['index_a'])
+
+    conveyor.index.remove(handle=client.handle, app_id='index_a', groups=['b', 'c'])
+    assert (indexed('b'), indexed('c')) == ([], [])
+    assert conveyor.index.groups_of(handle=client.handle, app_id='index_missing') == []
+
+
+def test_rebuild():
+    application('index_a', ['a']).write(client.handle)
+    application('index_b', ['a', 'b']).write(client.handle)
+    conveyor.zookeeper.create_r(client.handle, conveyor.index.path_for('c', 'index_a'))
+
+    assert conveyor.index.rebuild(handle=client.handle) == {'added': ['a/index_a', 'a/index_b', 'b/index_b'], 'removed': ['c/index_a']}
+    assert (indexed('a'), indexed('b'), indexed('c')) == (['index_a', 'index_b'], ['index_b'], [])
+    assert conveyor.index.rebuild(handle=client.handle) == {'added': [], 'removed': []}
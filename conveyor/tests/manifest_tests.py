@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+
+import conveyor
+import conveyor.accounting
+
+
+client = None
+operations = None
+
+
+def setup():
+    global client, operations
+
+    conveyor.zookeeper.set_backend('memory')
+    operations = conveyor.accounting.install()
+    operations.backend.supports_multi = True
+
+    client = conveyor.Conveyor()
+
+
+def teardown():
+    for name in ('manifest_a', 'manifest_b', 'manifest_c'):
+        path = conveyor.zookeeper.path_join('applications', name)
+        if conveyor.zookeeper.exists(client.handle, path):
+            conveyor.nodes.delete(handle=client.handle, path=path)
+
+    client.close()
+    conveyor.accounting.uninstall()
+
+
+def applications(versions):
+    return [conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', name), data={'version': version, 'groups': ['test_group'], 'slots': 2}) for name, version in sorted(versions.items())]
+
+
+def test_load():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    try:
+        os.write(fd, json.dumps({'applications': {'manifest_a': {'version': '1.0', 'groups': ['a', 'b'], 'deploy-cmd': '/bin/true'}}}))
+        os.close(fd)
+        manifest = conveyor.manifest.load(path)
+    finally:
+        os.unlink(path)
+
+    assert manifest == {'manifest_a': {'version': '1.0', 'groups': 'a, b', 'deploy-cmd': '/bin/true'}}
+    assert conveyor.util.read_options(manifest['manifest_a'], to_list=['groups'])['groups'] == ['a', 'b']
+
+
+def test_apply():
+    summary = conveyor.manifest.apply(handle=client.handle, applications=applications({'manifest_a': '1.0', 'manifest_b': '1.0'}))
+    assert summary == {'created': ['manifest_a', 'manifest_b'], 'updated': [], 'unchanged': []}
+
+    # Runtime fields are not part of the definition
+    app = conveyor.nodes.Application.read(handle=client.handle, path='/applications/manifest_a')
+    app.data['slots'] = 0
+    app.write(handle=client.handle)
+
+    operations.reset()
+    summary = conveyor.manifest.apply(handle=client.handle, applications=applications({'manifest_a': '1.0', 'manifest_b': '2.0', 'manifest_c': '1.0'}))
+    assert summary == {'created': ['manifest_c'], 'updated': ['manifest_b'], 'unchanged': ['manifest_a']}
+    assert [(o.name, o.path) for o in operations.select(names=conveyor.accounting.WRITES)] == [('multi', '/applications/manifest_b'), ('create', '/groups/test_group/applications/manifest_c')]
+    assert sorted(conveyor.zookeeper.get_children(client.handle, conveyor.index.path_for('test_group'))) == ['manifest_a', 'manifest_b', 'manifest_c']
+
+    assert conveyor.nodes.Application.read(handle=client.handle, path='/applications/manifest_a').data['slots'] == 0
+    assert conveyor.nodes.Application.read(handle=client.handle, path='/applications/manifest_b').data['version'] == '2.0'
+
+
+def test_apply_resets_results():
+    conveyor.manifest.apply(handle=client.handle, applications=applications({'manifest_a': '1.0'}))
+    app = conveyor.nodes.Application.read(handle=client.handle, path='/applications/manifest_a')
+    result_path = conveyor.nodes.DeploymentResult.path_for('manifest_a', app.results_key(), 'host')
+    conveyor.nodes.DeploymentResult(path=result_path, data={'result': 'failed'}).write(client.handle)
+    app.data['failures'] = 1
+    app.write(handle=client.handle)
+
+    # re-publishing the same version lets failed hosts try again, without deleting anything
+    wanted = applications({'manifest_a': '1.0'})
+    wanted[0].data['deploy_cmd'] = '/bin/true'
+    operations.reset()
+    assert conveyor.manifest.apply(handle=client.handle, applications=wanted)['updated'] == ['manifest_a']
+    assert operations.select('delete') == []
+
+    app = conveyor.nodes.Application.read(handle=client.handle, path='/applications/manifest_a')
+    assert app.data['failures'] == 0
+    assert not app.deployed(handle=client.handle, host_id='host')
+    assert conveyor.zookeeper.exists(client.handle, result_path)
+    app.delete_results(handle=client.handle)
+
+
+def test_apply_conflict():
+    conveyor.manifest.apply(handle=client.handle, applications=applications({'manifest_a': '1.0', 'manifest_b': '1.0'}))
+
+    # Both updates of manifest_b are based on the same version, so the second one conflicts and nothing is written
+    try:
+        conveyor.manifest.apply(handle=client.handle, applications=applications({'manifest_a': '3.0', 'manifest_b': '3.0'}) + applications({'manifest_b': '4.0'}))
+        assert False
+    except conveyor.zookeeper.BadVersionException:
+        pass
+
+    for name in ('manifest_a', 'manifest_b'):
+        assert conveyor.nodes.Application.read(handle=client.handle, path=conveyor.zookeeper.path_join('applications', name)).data['version'] == '1.0'
@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+
+import threading
+
+import conveyor
+from conveyor.tests import wait_for
+
+
+backend = None
+
+
+def setup():
+    global backend
+
+    backend = conveyor.zookeeper.set_backend('memory')
+
+
+def connect(servers='localhost:2181/conveyor', clientid=None):
+    events = []
+    connected = threading.Event()
+
+    def watcher(handle, type, state, path):
+        events.append((type, state, path))
+        if state == conveyor.zookeeper.CONNECTED_STATE:
+            connected.set()
+
+    handle = conveyor.zookeeper.init(servers, watcher, 10000, clientid)
+    connected.wait(1)
+    return handle, events
+
+
+def test_create_get_set_delete():
+    handle, events = connect()
+    assert conveyor.zookeeper.create(handle, '/a', 'data', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0) == '/a'
+    data, stat = conveyor.zookeeper.get(handle, '/a')
+    assert data == 'data' and stat['version'] == 0
+
+    conveyor.zookeeper.set(handle, '/a', 'new data', 0)
+    try:
+        conveyor.zookeeper.set(handle, '/a', 'newer data', 0)
+        assert False
+    except conveyor.zookeeper.BadVersionException:
+        pass
+    assert conveyor.zookeeper.get(handle, '/a')[0] == 'new data'
+
+    conveyor.zookeeper.delete(handle, '/a')
+    assert conveyor.zookeeper.exists(handle, '/a') is None
+    conveyor.zookeeper.close(handle)
+
+
+def test_errors():
+    handle, events = connect()
+    try:
+        conveyor.zookeeper.create(handle, '/missing/child', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+        assert False
+    except conveyor.zookeeper.NoNodeException:
+        pass
+
+    conveyor.zookeeper.create_r(handle, '/b/c')
+    try:
+        conveyor.zookeeper.delete(handle, '/b')
+        assert False
+    except conveyor.zookeeper.NotEmptyException:
+        pass
+
+    conveyor.zookeeper.delete_r(handle, '/b')
+    conveyor.zookeeper.close(handle)
+
+
+def test_chroot():
+    handle, events = connect('localhost:2181/chroot')
+    conveyor.zookeeper.create(handle, '/a', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+    other, events = connect('localhost:2181')
+    assert conveyor.zookeeper.exists(other, '/chroot/a')
+    conveyor.zookeeper.close(handle)
+    conveyor.zookeeper.close(other)
+
+
+def test_sequence_nodes():
+    handle, events = connect()
+    conveyor.zookeeper.create(handle, '/seq', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+    first = conveyor.zookeeper.create(handle, '/seq/n-', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], conveyor.zookeeper.SEQUENCE)
+    second = conveyor.zookeeper.create(handle, '/seq/n-', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], conveyor.zookeeper.SEQUENCE)
+    assert (first, second) == ('/seq/n-0000000000', '/seq/n-0000000001')
+    conveyor.zookeeper.delete_r(handle, '/seq')
+    conveyor.zookeeper.close(handle)
+
+
+def test_watches_fire_once():
+    handle, events = connect()
+    fired = []
+
+    def watcher(handle, type, state, path):
+        fired.append((type, path))
+
+    assert conveyor.zookeeper.exists(handle, '/w', watcher) is None
+    conveyor.zookeeper.create(handle, '/w', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+    conveyor.zookeeper.get_children(handle, '/w', watcher)
+    conveyor.zookeeper.create(handle, '/w/x', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+    conveyor.zookeeper.create(handle, '/w/y', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+
+    assert wait_for(lambda: len(fired) == 2)
+    assert fired == [(conveyor.zookeeper.CREATED_EVENT, '/w'), (conveyor.zookeeper.CHILD_EVENT, '/w')]
+    conveyor.zookeeper.delete_r(handle, '/w')
+    conveyor.zookeeper.close(handle)
+
+
+def test_ephemeral_nodes_are_deleted_on_expiry():
+    handle, events = connect()
+    other, other_events = connect()
+    conveyor.zookeeper.create(handle, '/e', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], conveyor.zookeeper.EPHEMERAL)
+    assert conveyor.zookeeper.exists(other, '/e')
+
+    backend.expire(handle)
+    assert conveyor.zookeeper.exists(other, '/e') is None
+    assert wait_for(lambda: (conveyor.zookeeper.SESSION_EVENT, conveyor.zookeeper.EXPIRED_SESSION_STATE, '') in events)
+    try:
+        conveyor.zookeeper.get(handle, '/')
+        assert False
+    except conveyor.zookeeper.SessionExpiredException:
+        pass
+    conveyor.zookeeper.close(other)
+
+
+def test_session_resumption():
+    handle, events = connect()
+    conveyor.zookeeper.create(handle, '/r', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], conveyor.zookeeper.EPHEMERAL)
+
+    resumed, events = connect(clientid=conveyor.zookeeper.client_id(handle))
+    assert conveyor.zookeeper.client_id(resumed) == conveyor.zookeeper.client_id(handle)
+    assert conveyor.zookeeper.exists(resumed, '/r')['ephemeralOwner'] == conveyor.zookeeper.client_id(handle)[0]
+    conveyor.zookeeper.close(resumed)
+
+    expired, events = connect(clientid=conveyor.zookeeper.client_id(handle))
+    assert wait_for(lambda: (conveyor.zookeeper.SESSION_EVENT, conveyor.zookeeper.EXPIRED_SESSION_STATE, '') in events)
+
+
+def test_disconnect_defers_watch_events():
+    handle, events = connect()
+    other, other_events = connect()
+    fired = []
+
+    conveyor.zookeeper.create(handle, '/d', '', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE], 0)
+    conveyor.zookeeper.get(handle, '/d', lambda h, type, state, path: fired.append((type, path)))
+
+    backend.disconnect(handle)
+    try:
+        conveyor.zookeeper.get(handle, '/d')
+        assert False
+    except conveyor.zookeeper.ConnectionLossException:
+        pass
+
+    conveyor.zookeeper.set(other, '/d', 'changed')
+    assert not wait_for(lambda: (conveyor.zookeeper.CHANGED_EVENT, '/d') in fired, timeout=0.1)
+
+    backend.reconnect(handle)
+    assert wait_for(lambda: (conveyor.zookeeper.CHANGED_EVENT, '/d') in fired)
+    conveyor.zookeeper.delete(other, '/d')
+    conveyor.zookeeper.close(handle)
+    conveyor.zookeeper.close(other)
+
+
+def test_multi_is_atomic():
+    handle, events = connect()
+    acl = [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE]
+    conveyor.zookeeper.create(handle, '/m', 'a', acl, 0)
+
+    try:
+        conveyor.zookeeper.multi(handle, [
+            conveyor.zookeeper.create_op('/m/child', ''),
+            conveyor.zookeeper.create_op('/m/seq-', '', acl, conveyor.zookeeper.SEQUENCE),
+            conveyor.zookeeper.set_op('/m', 'b', 0),
+            conveyor.zookeeper.check_op('/m', 0)
+        ])
+        assert False
+    except conveyor.zookeeper.BadVersionException:
+        pass
+
+    data, stat = conveyor.zookeeper.get(handle, '/m')
+    assert (data, stat['version'], stat['numChildren']) == ('a', 0, 0)
+
+    assert conveyor.zookeeper.multi(handle, [
+        conveyor.zookeeper.check_op('/m', 0),
+        conveyor.zookeeper.create_op('/m/child', ''),
+        conveyor.zookeeper.set_op('/m', 'b', 0),
+        conveyor.zookeeper.delete_op('/m/child')
+    ]) == [0, '/m/child', 0, 0]
+    assert conveyor.zookeeper.get(handle, '/m')[0] == 'b'
+
+    conveyor.zookeeper.delete(handle, '/m')
+    conveyor.zookeeper.close(handle)
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+
+import urllib2
+
+import conveyor
+
+
+def test_counter_and_gauge():
+    registry = conveyor.metrics.Registry()
+    counter = registry.counter('test_total', 'A counter', labels=('name',))
+    counter.inc(('a',))
+    counter.inc(('a',), 2)
+    registry.gauge('test_gauge', 'A gauge', function=lambda: [((), 7)])
+
+    assert registry.render() == '\n'.join([
+        '# HELP test_total A counter',
+        '# TYPE test_total counter',
+        'test_total{name="a"} 3.0',
+        '# HELP test_gauge A gauge',
+        '# TYPE test_gauge gauge',
+        'test_gauge 7.0',
+    ]) + '\n'
+
+
+def test_histogram():
+    registry = conveyor.metrics.Registry()
+    histogram = registry.histogram('test_seconds', 'A histogram', buckets=(1, 10))
+    histogram.observe(0.5)
+    histogram.observe(5)
+    histogram.observe(50)
+
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{le="1.0"} 1' in lines
+    assert 'test_seconds_bucket{le="10.0"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_sum 55.5' in lines
+    assert 'test_seconds_count 3' in lines
+
+
+def test_label_escaping():
+    assert conveyor.metrics.format_labels(('a',), ('say "hi"\n',)) == '{a="say \\"hi\\"\\n"}'
+
+
+def test_metrics_server():
+    registry = conveyor.metrics.Registry()
+    registry.gauge('test_gauge', 'A gauge', function=lambda: [((), 1)])
+    server = conveyor.metrics.MetricsServer(('127.0.0.1', 0), registry).start()
+    try:
+        assert 'test_gauge 1.0' in urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]).read()
+    finally:
+        server.shutdown()
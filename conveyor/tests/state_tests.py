@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+import time
+
+import conveyor
+
+
+state_dir = None
+
+
+def setup():
+    global state_dir
+
+    state_dir = tempfile.mkdtemp()
+
+
+def test_record_and_lookup():
+    store = conveyor.state.StateStore(path=state_dir)
+    store.record('app', '1.0', 'fingerprint')
+    assert store.lookup('app', 'fingerprint') == '1.0'
+    assert store.lookup('app', 'other fingerprint') is None
+    assert store.lookup('other app', 'fingerprint') is None
+    store.close()
+
+
+def test_survives_restarts():
+    store = conveyor.state.StateStore(path=state_dir)
+    store.record('app', '2.0', 'fingerprint')
+    store.close()
+
+    store = conveyor.state.StateStore(path=state_dir)
+    assert store.lookup('app', 'fingerprint') == '2.0'
+    store.invalidate('app')
+    assert store.lookup('app', 'fingerprint') is None
+    store.close()
+
+
+def test_ttl():
+    store = conveyor.state.StateStore(path=state_dir, ttl=-1)
+    store.record('app', '1.0', 'fingerprint')
+    assert store.lookup('app', 'fingerprint') is None
+    store.close()
+
+
+def test_fingerprint():
+    app = conveyor.nodes.Application(path='/applications/app', data={'get_version_cmd': 'a', 'deploy_cmd': 'b'})
+    assert conveyor.state.fingerprint(app) == conveyor.state.fingerprint(conveyor.nodes.Application(path='/applications/app', data={'get_version_cmd': 'a', 'deploy_cmd': 'b', 'version': '2'}))
+    assert conveyor.state.fingerprint(app) != conveyor.state.fingerprint(conveyor.nodes.Application(path='/applications/app', data={'get_version_cmd': 'a', 'deploy_cmd': 'c'}))
+    assert conveyor.state.fingerprint(app) != conveyor.state.fingerprint(conveyor.nodes.Application(path='/applications/app', data={'get_version_cmd': 'a', 'deploy_cmd': 'b', 'deploy_argv': ['b']}))
+
+
+def test_ttl_given_as_string():
+    store = conveyor.state.StateStore(path=state_dir, ttl='1')
+    store.db.execute('INSERT OR REPLACE INTO deployments (id, version, fingerprint, recorded) VALUES (?, ?, ?, ?)', ('app', '1.0', 'fingerprint', time.time() - 100000))
+    assert store.lookup('app', 'fingerprint') is None
+    store.close()
+
+
+def teardown():
+    shutil.rmtree(state_dir)
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import conveyor
+import conveyor.accounting
+
+
+client = None
+operations = None
+
+
+def setup():
+    global client, operations
+
+    conveyor.zookeeper.set_backend('memory')
+    operations = conveyor.accounting.install()
+
+    client = conveyor.Conveyor()
+
+
+def teardown():
+    client.close()
+    conveyor.accounting.uninstall()
+
+
+def test_async_reads():
+    path = conveyor.zookeeper.path_join('status_async')
+    conveyor.zookeeper.create(client.handle, path, 'data', [conveyor.zookeeper.ZOO_OPEN_ACL_UNSAFE])
+    try:
+        reads = conveyor.status.Reads(client.handle)
+        reads.get('node', path)
+        reads.get('missing', path + '_missing')
+        reads.get_children('children', path)
+        reads.wait()
+
+        assert reads.results['node'][0] == 'data'
+        assert reads.results['children'] == []
+        assert isinstance(reads.errors['missing'], conveyor.zookeeper.NoNodeException)
+        assert operations.reads(prefix=path) == 2
+    finally:
+        conveyor.nodes.delete(handle=client.handle, path=path)
+
+
+def test_rollout():
+    app = conveyor.nodes.Application(path=conveyor.zookeeper.path_join('applications', 'status_app'), data={'version': '2.0', 'groups': ['web'], 'slots': 1})
+    app.write(client.handle)
+
+    sessions = []
+    for i in range(6):
+        host = conveyor.Conveyor()
+        sessions.append(host)
+        conveyor.nodes.Host(path=conveyor.zookeeper.path_join('hosts', 'status_host%d' % i), data={'groups': i < 5 and ['web'] or ['db']}).write(host.handle)
+
+    try:
+        for i, result in ((0, True), (1, True), (2, False)):
+            conveyor.nodes.DeploymentResult(path=conveyor.nodes.DeploymentResult.path_for(app.id, '2.0', 'status_host%d' % i), data={'result': result and 'successful' or 'failed'}).write(client.handle)
+        conveyor.nodes.DeploymentResult(path=conveyor.nodes.DeploymentResult.path_for(app.id, '1.0', 'status_host4'), data={'result': 'successful'}).write(client.handle)
+        conveyor.nodes.DeploymentSlot(path=conveyor.zookeeper.path_join(app.path, 'status_host3', relative=True)).write(sessions[3].handle)
+
+        operations.reset()
+        summary = conveyor.status.rollout(handle=client.handle, app_id=app.id)
+        assert summary == {
+            'application': 'status_app',
+            'version': '2.0',
+            'slots': 1,
+            'failures': 0,
+            'failed_max': 0,
+            'hosts': 5,
+            'successful': 2,
+            'failed': 1,
+            'skipped': 0,
+            'pending': 1,
+            'in_flight': ['status_host3'],
+            'queued': [],
+            'failed_hosts': ['status_host2']
+        }, summary
+        assert operations.writes() == 0
+    finally:
+        for host in sessions:
+            host.close()
+        conveyor.zookeeper.delete_r(client.handle, app.path)
+        app.delete_results(handle=client.handle)
+
+    try:
+        conveyor.status.rollout(handle=client.handle, app_id='status_missing')
+    except conveyor.zookeeper.NoNodeException:
+        pass
+    else:
+        assert False
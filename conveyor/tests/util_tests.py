@@ -9,3 +9,8 @@ def test_comma_str_to_list():
 
 def test_read_options():
     assert conveyor.util.read_options({'a': 1, 'b': 2, 'c': 3}, {'a': 9, 'b': 2}) == {'a': 9, 'b': 2, 'c': 3}
+
+
+def test_backoff():
+    for attempt in range(1, 20):
+        assert 0 <= conveyor.util.backoff(attempt, 0.01, 1.0) <= min(1.0, 0.01 * 2 ** (attempt - 1))
@@ -9,6 +9,7 @@ client = None
 def setup():
     global client
 
+    conveyor.zookeeper.set_backend('memory')
     client = conveyor.Conveyor()
 
 
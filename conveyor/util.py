@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import random
 import string
 
 
@@ -33,3 +34,9 @@ def read_options(*sources, **options):
                     data[name] = value
 
     return data
+
+
+def backoff(attempt, base, cap):
+    """Return a randomized exponential backoff delay for the given attempt (never more than cap)"""
+
+    return random.uniform(0, min(cap, base * 2 ** max(0, attempt - 1)))
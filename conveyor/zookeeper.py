@@ -1,16 +1,285 @@
 from __future__ import absolute_import
 
 import logging
-
-from zookeeper import *
+import os
 
 
 PATH_SEPARATOR = '/'
+
+PERM_READ = 1
+PERM_WRITE = 2
+PERM_CREATE = 4
+PERM_DELETE = 8
+PERM_ADMIN = 16
+PERM_ALL = 31
 ZOO_OPEN_ACL_UNSAFE = {"perms":PERM_ALL, "scheme":"world", "id":"anyone"};
+
 PERSISTENT = 0
+EPHEMERAL = 1
+SEQUENCE = 2
+
+EXPIRED_SESSION_STATE = -112
+AUTH_FAILED_STATE = -113
+CONNECTING_STATE = 1
+ASSOCIATING_STATE = 2
+CONNECTED_STATE = 3
+
+CREATED_EVENT = 1
+DELETED_EVENT = 2
+CHANGED_EVENT = 3
+CHILD_EVENT = 4
+SESSION_EVENT = -1
+NOTWATCHING_EVENT = -2
+
+BACKENDS = {
+    'binding': 'conveyor.backends.binding.BindingBackend',
+    'memory': 'conveyor.backends.memory.MemoryBackend'
+}
+DEFAULT_BACKEND = os.environ.get('CONVEYOR_BACKEND', 'binding')
+
+
+class ZooKeeperException(Exception):
+    """Base class for all ZooKeeper errors"""
+
+class SystemErrorException(ZooKeeperException):
+    """System error"""
+
+class RuntimeInconsistencyException(ZooKeeperException):
+    """Runtime inconsistency"""
+
+class DataInconsistencyException(ZooKeeperException):
+    """Data inconsistency"""
+
+class ConnectionLossException(ZooKeeperException):
+    """Connection to the server has been lost"""
+
+class MarshallingErrorException(ZooKeeperException):
+    """Error while marshalling or unmarshalling data"""
+
+class UnimplementedException(ZooKeeperException):
+    """Operation is unimplemented"""
+
+class OperationTimeoutException(ZooKeeperException):
+    """Operation timeout"""
+
+class BadArgumentsException(ZooKeeperException):
+    """Invalid arguments"""
+
+class InvalidStateException(ZooKeeperException):
+    """Invalid zhandle state"""
+
+class ApiErrorException(ZooKeeperException):
+    """API error"""
+
+class NoNodeException(ApiErrorException):
+    """Node does not exist"""
+
+class NoAuthException(ApiErrorException):
+    """Not authenticated"""
+
+class BadVersionException(ApiErrorException):
+    """Version conflict"""
+
+class NoChildrenForEphemeralsException(ApiErrorException):
+    """Ephemeral nodes may not have children"""
+
+class NodeExistsException(ApiErrorException):
+    """The node already exists"""
+
+class NotEmptyException(ApiErrorException):
+    """The node has children"""
+
+class SessionExpiredException(ApiErrorException):
+    """The session has been expired by the server"""
+
+class InvalidCallbackException(ApiErrorException):
+    """Invalid callback specified"""
+
+class InvalidACLException(ApiErrorException):
+    """Invalid ACL specified"""
+
+class AuthFailedException(ApiErrorException):
+    """Client authentication failed"""
+
+class ClosingException(ApiErrorException):
+    """ZooKeeper is closing"""
+
+class NothingException(ApiErrorException):
+    """(not error) no server responses to process"""
+
+class SessionMovedException(ApiErrorException):
+    """Session moved to another server, so operation is ignored"""
+
+
+backend = None
+
+
+def set_backend(name_or_backend):
+    """Select the coordination backend by name (see BACKENDS) or instance and return it"""
+
+    global backend
+
+    if isinstance(name_or_backend, basestring):
+        module_name, class_name = BACKENDS[name_or_backend].rsplit('.', 1)
+        module = __import__(module_name, fromlist=[class_name])
+        name_or_backend = getattr(module, class_name)()
+
+    backend = name_or_backend
+    logging.getLogger().debug('Using coordination backend: %s', backend.__class__.__name__)
+    return backend
+
+
+def get_backend():
+    """Return the current coordination backend (loading the default one if necessary)"""
+
+    if backend is None:
+        set_backend(DEFAULT_BACKEND)
+    return backend
+
+
+def init(servers, watcher=None, timeout=10000, clientid=None):
+    """Open a session and return its handle"""
+
+    return get_backend().init(servers, watcher, timeout, clientid)
+
+
+def close(handle):
+    """Close a session"""
+
+    return get_backend().close(handle)
+
+
+def client_id(handle):
+    """Return the (session id, password) tuple of a session"""
+
+    return get_backend().client_id(handle)
+
+
+def state(handle):
+    """Return the connection state of a session"""
+
+    return get_backend().state(handle)
+
+
+def create(handle, path, data, acl, flags=PERSISTENT):
+    """Create a node and return its path"""
+
+    return get_backend().create(handle, path, data, acl, flags)
+
+
+def get(handle, path, watcher=None):
+    """Return the (data, stat) tuple of a node"""
+
+    return get_backend().get(handle, path, watcher)
+
+
+def set(handle, path, data, version=-1):
+    """Update the data of a node (if its version matches, unless version is -1)"""
+
+    return get_backend().set(handle, path, data, version)
+
+
+def get_children(handle, path, watcher=None):
+    """Return the names of the children of a node"""
+
+    return get_backend().get_children(handle, path, watcher)
+
+
+def exists(handle, path, watcher=None):
+    """Return the stat of a node (or None if it doesn't exist)"""
+
+    return get_backend().exists(handle, path, watcher)
+
+
+def delete(handle, path, version=-1):
+    """Delete a node (if its version matches, unless version is -1)"""
+
+    return get_backend().delete(handle, path, version)
+
+
+def aget(handle, path, completion, watcher=None):
+    """Read a node asynchronously (completion is called with (handle, error, (data, stat)) on the event thread)"""
+
+    return get_backend().aget(handle, path, completion, watcher)
+
+
+def aget_children(handle, path, completion, watcher=None):
+    """List the children of a node asynchronously (completion is called with (handle, error, children))"""
+
+    return get_backend().aget_children(handle, path, completion, watcher)
+
+
+def aexists(handle, path, completion, watcher=None):
+    """Stat a node asynchronously (completion is called with (handle, error, stat or None))"""
+
+    return get_backend().aexists(handle, path, completion, watcher)
+
+
+def create_op(path, data, acl=[ZOO_OPEN_ACL_UNSAFE], flags=PERSISTENT):
+    """Return a create operation for multi()"""
+
+    return ('create', path, data, acl, flags)
+
+
+def set_op(path, data, version=-1):
+    """Return a set operation for multi()"""
+
+    return ('set', path, data, version)
+
+
+def delete_op(path, version=-1):
+    """Return a delete operation for multi()"""
+
+    return ('delete', path, version)
+
+
+def check_op(path, version):
+    """Return a version check operation for multi()"""
+
+    return ('check', path, version)
+
+
+def supports_multi():
+    """Return True if the backend can run multi-operation transactions"""
+
+    return get_backend().supports_multi
+
+
+def multi(handle, ops):
+    """Run a list of operations atomically and return their results (raises the first failing operation's exception)"""
+
+    return get_backend().multi(handle, ops)
+
+
+def transaction(handle, ops):
+    """Run a list of operations atomically if the backend supports it (otherwise one by one) and return their results"""
+
+    if supports_multi():
+        return multi(handle, ops)
+
+    results = []
+    for op in ops:
+        if op[0] == 'create':
+            results.append(create(handle, *op[1:]))
+        elif op[0] == 'set':
+            results.append(set(handle, *op[1:]))
+        elif op[0] == 'delete':
+            results.append(delete(handle, *op[1:]))
+        elif op[0] == 'check':
+            stat = exists(handle, op[1])
+            if stat is None:
+                raise NoNodeException('no node')
+            if stat['version'] != op[2]:
+                raise BadVersionException('version conflict')
+            results.append(0)
+    return results
+
+
+def deterministic_conn_order(value):
+    """Connect to servers in the order they are listed (for testing)"""
 
+    return get_backend().deterministic_conn_order(value)
 
-set_debug_level(0)
 
 def path_join(*path_parts, **options):
     """Construct a path from a list of path parts"""